@@ -1,6 +1,11 @@
 from raybot.model import db
-from raybot.bot import dp
-from raybot.cli import buildings, photos, test_map, missing
+from raybot import config
+from raybot.bot import dp, storage
+from raybot.util.map import shutdown_executor
+from raybot.util.log import sink
+from raybot.util.session import sessions
+from raybot.util.broadcast import broadcaster
+from raybot.cli import buildings, photos, test_map, missing, mbtiles, plans, migrate, bench
 import raybot.handlers  # noqa
 import logging
 import sys
@@ -9,13 +14,23 @@ from aiogram import executor
 
 
 async def shutdown(dp):
+    await broadcaster.close()
+    shutdown_executor()
+    sessions.save()
+    await sink.close()
+    await storage.close()
     await db.close()
 
 
 def main():
     if len(sys.argv) < 2 or os.path.isdir(sys.argv[1]):
         logging.basicConfig(level=logging.INFO)
-        executor.start_polling(dp, skip_updates=True, on_shutdown=shutdown)
+        sessions.load()
+        if config.WEBHOOK:
+            from raybot.webhook import run_webhook
+            run_webhook(on_shutdown=shutdown)
+        else:
+            executor.start_polling(dp, skip_updates=True, on_shutdown=shutdown)
     else:
         cmd = sys.argv[1].lower()
         if cmd == 'buildings':
@@ -26,6 +41,14 @@ def main():
             test_map.run()
         elif cmd == 'missing':
             missing.run()
+        elif cmd == 'mbtiles':
+            mbtiles.run()
+        elif cmd == 'plans':
+            plans.run()
+        elif cmd == 'migrate':
+            migrate.run()
+        elif cmd == 'bench':
+            bench.run()
         else:
             print('Supported commands:')
             print()
@@ -33,6 +56,10 @@ def main():
             print('photos — print missing and stray photos')
             print('missing — print pois with missing important keys')
             print('map — generate a map image')
+            print('mbtiles — pack the tiles directory into an MBTiles file')
+            print('plans — check that database queries use indexes')
+            print('migrate — upgrade the database schema')
+            print('bench — check and time in-memory indexes and caches on synthetic data')
 
 
 if __name__ == '__main__':
@@ -2,15 +2,18 @@ from raybot import config
 from raybot.model import db
 from raybot.actions.poi import print_poi_by_key
 from raybot.bot import bot
-from raybot.util import has_keyword, tr
+from raybot.util import tr
 from aiogram import types
 from aiogram.utils.callback_data import CallbackData
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.dispatcher import FSMContext
-from typing import List
+from bisect import bisect_right
+from typing import List, Dict, Tuple
 
 
 HOUSE_CB = CallbackData('house', 'id')
+# building -> (entrances, first apartments, [(entrance, floor starts or None)])
+APARTMENTS: Dict[str, tuple] = {}
 
 
 class AddrState(StatesGroup):
@@ -18,25 +21,38 @@ class AddrState(StatesGroup):
     house = State()
 
 
+def index_streets(streets: List[dict]) -> Tuple[Dict[str, tuple], Dict[str, dict]]:
+    """Maps street keywords, and keywords with house numbers like "mst6",
+    to (street, house) pairs. First match in the file wins. Also returns
+    streets by name."""
+    keywords = {}
+    names = {}
+    for street in streets:
+        names.setdefault(street['name'], street)
+        for k in street['keywords']:
+            keywords.setdefault(k, (street, None))
+        for house in street['buildings']:
+            for k in street['keywords']:
+                keywords.setdefault(k + str(house), (street, house))
+    return keywords, names
+
+
+STREET_KEYWORDS, STREETS = index_streets(config.ADDR.get('streets', []))
+
+
 async def test_address(message: types.Message, tokens: List[str], state: FSMContext) -> bool:
-    if 'streets' not in config.ADDR:
+    street, house = STREET_KEYWORDS.get(tokens[0], (None, None))
+    if not street:
         return False
-    for street in config.ADDR['streets']:
-        if has_keyword(tokens[0], street['keywords']):
-            if len(tokens) == 1:
-                await AddrState.street.set()
-                await state.set_data({'street': street['name']})
-                await print_street(message, street)
-            else:
-                await handle_building(message.from_user, street, tokens[1:], state)
-            return True
-
-        # Check buildings like "mst6"
-        for house in street['buildings']:
-            if has_keyword(tokens[0], street['keywords'], str(house)):
-                await handle_building(message.from_user, street, [house] + tokens[1:], state)
-                return True
-    return False
+    if house is not None:
+        await handle_building(message.from_user, street, [house] + tokens[1:], state)
+    elif len(tokens) == 1:
+        await AddrState.street.set()
+        await state.set_data({'street': street['name']})
+        await print_street(message, street)
+    else:
+        await handle_building(message.from_user, street, tokens[1:], state)
+    return True
 
 
 async def print_street(message, street):
@@ -83,25 +99,7 @@ async def print_apartment(user: types.User, building: str, apartment):
         return
 
     entrances = [building] + await db.get_entrances(building)
-    floor = None
-    entrance = None
-    entrance_first = None
-    for e in entrances:
-        e_apts = config.ADDR['apartments'].get(e)
-        if e_apts is None:
-            continue
-        elif isinstance(e_apts, list):
-            if apartment >= e_apts[0]:
-                if entrance is None or entrance_first < e_apts[0]:
-                    entrance = e
-                    entrance_first = e_apts[0]
-                    floor = len([a for a in e_apts if a <= apartment])
-        elif apartment >= e_apts:
-            if entrance is None or entrance_first < e_apts:
-                entrance = e
-                entrance_first = e_apts
-                floor = None
-
+    entrance, floor = find_entrance(building, entrances, apartment)
     if entrance is None:
         comment = None
     elif floor is None:
@@ -109,3 +107,35 @@ async def print_apartment(user: types.User, building: str, apartment):
     else:
         comment = tr('floor', apt=apartment, floor=floor)
     await print_poi_by_key(user, entrance, comment, buttons=False)
+
+
+def index_entrances(entrances: List[str]) -> Tuple[List[int], list]:
+    """Builds a table of entrances sorted by first apartment numbers.
+    When two entrances start with the same number, the first one wins."""
+    rows = {}
+    for e in entrances:
+        e_apts = config.ADDR['apartments'].get(e)
+        if e_apts is None:
+            continue
+        elif isinstance(e_apts, list):
+            floors = sorted(e_apts)
+            if e_apts and e_apts[0] not in rows:
+                rows[e_apts[0]] = (e, floors)
+        elif e_apts not in rows:
+            rows[e_apts] = (e, None)
+    firsts = sorted(rows)
+    return firsts, [rows[f] for f in firsts]
+
+
+def find_entrance(building: str, entrances: List[str], apartment: int):
+    """Returns an entrance and a floor for the apartment, both can be None."""
+    table = APARTMENTS.get(building)
+    if not table or table[0] != entrances:
+        table = (entrances, *index_entrances(entrances))
+        APARTMENTS[building] = table
+    _, firsts, rows = table
+    idx = bisect_right(firsts, apartment) - 1
+    if idx < 0:
+        return None, None
+    entrance, floors = rows[idx]
+    return entrance, None if floors is None else bisect_right(floors, apartment)
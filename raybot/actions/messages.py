@@ -1,25 +1,36 @@
 from raybot import config
 from raybot.bot import bot
 from raybot.util import get_user, tr
+from raybot.util.broadcast import broadcaster
 from raybot.model import db
-from asyncio import sleep
 from aiogram import types
+from typing import List
+
+
+async def get_moderator_ids() -> List[int]:
+    mods = [config.ADMIN]
+    for user in await db.get_role_users('moderator'):
+        if user.id not in mods:
+            mods.append(user.id)
+    return mods
 
 
 async def broadcast(message: types.Message):
-    mods = [config.ADMIN] + (await db.get_role_users('moderator'))
-    for user_id in mods:
-        await bot.send_message(user_id, tr('do_reply'))
-        await message.forward(user_id)
-        await sleep(0.5)
+    """Forwards the message to moderators. Returns without waiting for that."""
+    for user_id in await get_moderator_ids():
+        broadcaster.send(
+            user_id,
+            lambda user_id=user_id: bot.send_message(user_id, tr('do_reply')),
+            lambda user_id=user_id: message.forward(user_id),
+        )
 
 
-async def broadcast_str(message: str, except_id: int = None):
-    mods = [config.ADMIN] + (await db.get_role_users('moderator'))
-    for user_id in mods:
+async def broadcast_str(message: str, except_id: int = None,
+                        disable_notification: bool = None):
+    for user_id in await get_moderator_ids():
         if user_id != except_id:
-            await bot.send_message(user_id, message)
-            await sleep(0.5)
+            broadcaster.send(user_id, lambda user_id=user_id: bot.send_message(
+                user_id, message, disable_notification=disable_notification))
 
 
 async def process_reply(message: types.Message):
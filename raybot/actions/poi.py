@@ -1,13 +1,16 @@
 from raybot import config
 from raybot.model import db, POI, Location
 from raybot.bot import bot
-from raybot.util import h, get_user, get_map, pack_ids, uncap, tr
-import csv
+from raybot.util import h, get_user, get_map_photo, store_map_file_id, pack_ids, uncap, tr
+from raybot.util.log import sink
+from raybot.util.photos import photo_registry
 import re
 import os
+import time
 import random
+import asyncio
 import logging
-from typing import List, Tuple
+from typing import List, Tuple, Dict, Awaitable
 from datetime import datetime
 from aiogram import types
 from aiogram.utils.callback_data import CallbackData
@@ -51,14 +54,18 @@ def star_sort(star: Tuple[int, bool]):
 
 async def print_poi_list(user: types.User, query: str, pois: List[POI],
                          full: bool = False, shuffle: bool = True,
-                         relative_to: Location = None, comment: str = None):
+                         relative_to: Location = None, comment: str = None,
+                         ranked: bool = False):
+    """Set ranked when pois are sorted by relevance, to keep that order
+    for pois with the same number of stars."""
     max_buttons = 9 if not full else 20
     location = (await get_user(user)).location or relative_to
     if shuffle:
         if location:
             pois.sort(key=lambda p: location.distance(p.location))
         else:
-            random.shuffle(pois)
+            if not ranked:
+                random.shuffle(pois)
             stars = await db.stars_for_poi_list(user.id, [p.id for p in pois])
             if stars:
                 pois.sort(key=lambda p: star_sort(stars.get(p.id)), reverse=True)
@@ -105,15 +112,14 @@ async def print_poi_list(user: types.User, query: str, pois: List[POI],
             f'🔽 {config.MSG["all"]} {total_count}', callback_data=callback_data))
 
     # Make a map and send the message
-    map_file = get_map([poi.location for poi in pois], ref=location)
-    if not map_file:
+    map_key, map_photo = await get_map_photo([poi.location for poi in pois], ref=location)
+    if not map_photo:
         await bot.send_message(user.id, content, parse_mode=HTML, reply_markup=kbd)
     else:
-        await bot.send_photo(
-            user.id, types.InputFile(map_file.name),
-            caption=content, parse_mode=HTML,
-            reply_markup=kbd)
-        map_file.close()
+        msg = await bot.send_photo(
+            user.id, map_photo, caption=content, parse_mode=HTML, reply_markup=kbd)
+        if not isinstance(map_photo, str) and msg.photo:
+            store_map_file_id(map_key, msg.photo[-1].file_id)
 
 
 def relative_day(next_day):
@@ -242,50 +248,72 @@ async def make_house_keyboard(user: types.User, poi: POI):
 
 def log_poi(poi: POI):
     row = [datetime.now().strftime('%Y-%m-%d'), poi.id, poi.name]
+    sink.write('poi.log', row)
+
+
+async def get_poi_photos(poi: POI):
+    """Returns a list of photos (file ids or files) and a list of [name, size]
+    for photos that need their file ids stored."""
+    sizes = {}
+    for photo in [poi.photo_in, poi.photo_out]:
+        if photo:
+            size = photo_registry.size(photo + '.jpg')
+            if size is not None:
+                sizes[photo] = size
+    file_ids = {} if not sizes else await photo_registry.find(sizes)
+    photos = []
+    photo_names = []
+    for photo, size in sizes.items():
+        if photo in file_ids:
+            photos.append(file_ids[photo])
+            photo_names.append(None)
+        else:
+            photos.append(types.InputFile(os.path.join(config.PHOTOS, photo + '.jpg')))
+            photo_names.append([photo, size])
+    return photos, photo_names
+
+
+async def timed(timings: Dict[str, float], stage: str, coro: Awaitable):
+    start = time.perf_counter()
     try:
-        with open(os.path.join(config.LOGS, 'poi.log'), 'a') as f:
-            w = csv.writer(f, delimiter='\t')
-            w.writerow(row)
-    except IOError:
-        logging.warning('Failed to write log line: %s', row)
+        return await coro
+    finally:
+        timings[stage] = time.perf_counter() - start
 
 
 async def print_poi(user: types.User, poi: POI, comment: str = None, buttons: bool = True):
     log_poi(poi)
+    started = time.perf_counter()
+    timings: Dict[str, float] = {}
     chat_id = user.id
     content = describe_poi(poi)
     if comment:
         content += '\n\n' + h(comment)
 
-    # Prepare photos
-    photos = []
-    photo_names = []
-    for photo in [poi.photo_in, poi.photo_out]:
-        if photo:
-            path = os.path.join(config.PHOTOS, photo + '.jpg')
-            if os.path.exists(path):
-                file_ids = await db.find_file_ids({photo: os.path.getsize(path)})
-                if photo in file_ids:
-                    photos.append(file_ids[photo])
-                    photo_names.append(None)
-                else:
-                    photos.append(types.InputFile(path))
-                    photo_names.append([photo, os.path.getsize(path)])
-
-    # Generate a map
-    location = (await get_user(user)).location
-    map_file = get_map([poi.location], location)
-    if map_file:
-        photos.append(types.InputFile(map_file.name))
-        photo_names.append(None)
-
     # Prepare the inline keyboard
     if poi.tag == 'building':
-        kbd = await make_house_keyboard(user, poi)
+        kbd_task = make_house_keyboard(user, poi)
+    elif buttons:
+        kbd_task = make_poi_keyboard(user, poi)
     else:
-        kbd = None if not buttons else await make_poi_keyboard(user, poi)
+        kbd_task = asyncio.sleep(0)
+
+    # Prepare photos and a map, and the keyboard, at once
+    location = (await get_user(user)).location
+    (photos, photo_names), (map_key, map_photo), kbd = await asyncio.gather(
+        timed(timings, 'photos', get_poi_photos(poi)),
+        timed(timings, 'map', get_map_photo([poi.location], location)),
+        timed(timings, 'keyboard', kbd_task),
+    )
+    map_index = None
+    if map_photo:
+        photos.append(map_photo)
+        photo_names.append(None)
+        if not isinstance(map_photo, str):
+            map_index = len(photos) - 1
 
     # Send the message
+    sent = time.perf_counter()
     if not photos:
         msg = await bot.send_message(chat_id, content, parse_mode=HTML,
                                      reply_markup=kbd, disable_web_page_preview=True)
@@ -305,17 +333,22 @@ async def print_poi(user: types.User, poi: POI, comment: str = None, buttons: bo
                                    reply_markup=kbd, disable_web_page_preview=True)
         else:
             msg = await bot.send_media_group(chat_id, media=media)
-    if map_file:
-        map_file.close()
 
     # Store file_ids for new photos
     if isinstance(msg, list):
         file_ids = [m.photo[-1].file_id for m in msg if m.photo]
     else:
-        file_ids = [msg.photo[-1]] if msg.photo else []
+        file_ids = [msg.photo[-1].file_id] if msg.photo else []
     for i, file_id in enumerate(file_ids):
-        if photo_names[i]:
-            await db.store_file_id(photo_names[i][0], photo_names[i][1], file_id)
+        if i == map_index:
+            store_map_file_id(map_key, file_id)
+        elif photo_names[i]:
+            await photo_registry.store(photo_names[i][0], photo_names[i][1], file_id)
+
+    timings['send'] = time.perf_counter() - sent
+    timings['total'] = time.perf_counter() - started
+    logging.debug('POI %s card: %s', poi.id, ', '.join(
+        f'{k} {v * 1000:.0f} ms' for k, v in timings.items()))
 
 
 async def print_poi_by_key(user: types.User, poi_id: str, comment: str = None,
@@ -70,6 +70,7 @@ async def import_geojson(f):
         ?, ?, ?
     )""", values)
     await conn.commit()
+    db.snapshot.clear()
     await db.reindex()
 
 
@@ -79,11 +80,11 @@ async def export_geojson(f):
             return None
         return 'yes' if b else 'no'
 
-    conn = await db.get_db()
+    conn = await db.get_reader()
     features = []
-    cursor = await conn.execute(
+    rows = await conn.execute_fetchall(
         "select p1.*, h.str_id as house_id from poi p1 left join poi h on p1.house = h.rowid")
-    async for row in cursor:
+    for row in rows:
         props = {
             '$rowid': row['id'],
             'id': row['str_id'],
@@ -125,13 +126,13 @@ async def export_geojson(f):
 
 
 async def export_tags(f):
-    conn = await db.get_db()
-    cur = await conn.execute(
+    conn = await db.get_reader()
+    rows = await conn.execute_fetchall(
         "select id, name, tag, '', description, comment, address "
         "from poi where tag is null or tag not in ('building', 'entrance')")
     w = csv.writer(f)
     w.writerow('id name tag type description comment address'.split())
-    async for row in cur:
+    for row in rows:
         row = list(row)
         row[3] = config.TAGS['tags'].get(row[2], [''])[0]
         w.writerow(row)
@@ -158,6 +159,7 @@ async def import_tags(f):
             if tag not in new_tags or not new_tags[tag]:
                 new_tags[tag] = row['type'].strip()
     await conn.commit()
+    db.snapshot.clear()
 
     if not new_tags:
         return None
@@ -1,10 +1,10 @@
 from raybot import config
 from raybot.util import log
+from raybot.model.storage import FsmStorage
 from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 
 
 bot = Bot(token=config.TELEGRAM_TOKEN)
-storage = MemoryStorage()
+storage = FsmStorage(ttl=config.FSM_TTL * 3600, flush_interval=config.FSM_FLUSH_INTERVAL)
 dp = Dispatcher(bot, storage=storage)
 dp.middleware.setup(log.LoggingMiddleware())
@@ -0,0 +1,223 @@
+import asyncio
+import humanized_opening_hours as hoh
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from raybot import config
+from raybot.actions.addr import index_streets
+from raybot.model import db, POI
+from raybot.model.entities import parse_hours
+from raybot.model.migrations import split_script
+from raybot.util import has_keyword
+
+
+LETTERS = 'абвгдеёжзийклмнопрстуфхцчшщыэюя'
+
+
+def make_streets(count: int = 300, buildings: int = 60, seed: int = 1) -> list:
+    """Generates streets for addr.yml of a city. Keywords are prefixes
+    of street names, so short ones are shared between streets."""
+    rnd = random.Random(seed)
+    streets = []
+    for i in range(count):
+        name = ''.join(rnd.choice(LETTERS) for _ in range(rnd.randint(5, 12)))
+        keywords = [name[:n] for n in range(1, len(name) + 1, 2)]
+        houses = {}
+        for n in rnd.sample(range(1, buildings * 2), buildings):
+            house = str(n) + rnd.choice(['', '', '', 'а', 'к1', 'к2'])
+            houses[house] = f'h{i}_{house}'
+        streets.append({'name': f'ул. {name} {i}', 'keywords': keywords,
+                        'buildings': houses})
+    return streets
+
+
+def scan_streets(streets: list, token: str):
+    """Finds a street like test_address did before the index."""
+    for street in streets:
+        if has_keyword(token, street['keywords']):
+            return street, None
+        for house in street['buildings']:
+            if has_keyword(token, street['keywords'], str(house)):
+                return street, house
+    return None, None
+
+
+def bench_addr() -> int:
+    streets = make_streets()
+    started = time.perf_counter()
+    keywords, _ = index_streets(streets)
+    indexed = time.perf_counter() - started
+
+    rnd = random.Random(2)
+    tokens = rnd.sample(sorted(keywords), 2000) + [
+        ''.join(rnd.choice(LETTERS) for _ in range(6)) for _ in range(500)]
+    failed = 0
+    scan_time = lookup_time = 0
+    for token in tokens:
+        started = time.perf_counter()
+        expected = scan_streets(streets, token)
+        scan_time += time.perf_counter() - started
+        started = time.perf_counter()
+        street, house = keywords.get(token, (None, None))
+        lookup_time += time.perf_counter() - started
+        if (street, house) != expected:
+            failed += 1
+            print(f'Mismatch for "{token}": {expected[0] and expected[0]["name"]} '
+                  f'{expected[1]}, got {street and street["name"]} {house}')
+    print(f'Streets: {len(streets)} with {len(keywords)} keys, indexed in '
+          f'{indexed * 1000:.1f} ms. Per lookup: scan {scan_time / len(tokens) * 1e6:.1f} µs, '
+          f'index {lookup_time / len(tokens) * 1e6:.2f} µs. Mismatches: {failed}.')
+    return failed
+
+
+HOURS = ['Mo-Fr 09:00-18:00', 'Mo-Su 08:00-22:00', 'Mo-Fr 10:00-20:00; Sa 10:00-16:00',
+         '24/7', 'Mo-Sa 09:00-21:00; Su 10:00-18:00', None]
+
+
+def make_poi_rows(count: int = 2000) -> list:
+    """Returns rows from an in-memory poi table with common opening hours."""
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    with open(os.path.join(os.path.dirname(__file__), '..', 'model', 'create_tables.sql')) as f:
+        for statement in split_script(f.read()):
+            conn.execute(statement)
+    conn.executemany("insert into poi (name, lon, lat, hours) values (?, 27.6, 53.9, ?)",
+                     [(f'POI {i}', HOURS[i % len(HOURS)]) for i in range(count)])
+    return conn.execute("select poi.*, null as h_address from poi").fetchall()
+
+
+def bench_hours() -> int:
+    rows = make_poi_rows()
+    failed = 0
+    for hours in HOURS[:-1]:
+        if parse_hours(hours).is_open() != hoh.OHParser(hours).is_open():
+            failed += 1
+            print(f'Mismatch in is_open() for "{hours}"')
+
+    # Like POI.__init__ did before, parsing hours for every row
+    started = time.perf_counter()
+    for row in rows:
+        POI(row)
+        if row['hours']:
+            hoh.OHParser(row['hours'])
+    eager = time.perf_counter() - started
+
+    parse_hours.cache_clear()
+    started = time.perf_counter()
+    pois = [POI(row) for row in rows]
+    lazy = time.perf_counter() - started
+
+    # A list shows whether each POI is open, a card shows when that changes
+    started = time.perf_counter()
+    for poi in pois:
+        if poi.hours:
+            poi.hours.is_open()
+            poi.hours.is_open()
+            poi.hours.next_change()
+    used = time.perf_counter() - started
+    print(f'Hydrating {len(rows)} rows, per row: eager parsing {eager / len(rows) * 1e6:.1f} µs, '
+          f'lazy {lazy / len(rows) * 1e6:.1f} µs. Checking hours: '
+          f'{used / len(rows) * 1e6:.1f} µs per POI. Mismatches: {failed}.')
+    return failed
+
+
+async def fill_poi(count: int):
+    """Fills an empty database with POI, some of them buildings, entrances,
+    deleted or starred."""
+    conn = await db.get_db()
+    rows = []
+    for i in range(1, count + 1):
+        tag = 'building' if i % 20 == 0 else 'entrance' if i % 20 == 1 else None
+        rows.append((i, f'POI {i}', 27.6, 53.9, tag, 'gone' if i % 50 == 2 else None))
+    await conn.executemany("insert into poi (id, name, lon, lat, tag, delete_reason) "
+                           "values (?, ?, ?, ?, ?, ?)", rows)
+    await conn.executemany("insert into stars (poi_id, user_id) values (?, ?)",
+                           [(i, u) for i in range(3, count, 37) for u in range(i % 7)])
+    await conn.commit()
+
+
+async def time_calls(coro_func, times: int = 50) -> float:
+    started = time.perf_counter()
+    for _ in range(times):
+        await coro_func()
+    return (time.perf_counter() - started) / times
+
+
+async def bench_random_async() -> int:
+    # The way it was done before: sorting all eligible rows
+    async def old_random():
+        conn = await db.get_reader()
+        cursor = await conn.execute(
+            "select * from poi where id in (select id from poi "
+            "where (tag is null or tag not in ('building', 'entrance')) "
+            "and delete_reason is null order by random() limit 6)")
+        return [POI(r) async for r in cursor]
+
+    # Counting stars for every POI, before the poi_stars table
+    async def old_popular():
+        conn = await db.get_reader()
+        cursor = await conn.execute(
+            "select * from poi where delete_reason is null and "
+            "id in (select poi_id from stars group by poi_id having count(*) >= 2) "
+            "order by random() limit 9")
+        return [POI(r) async for r in cursor]
+
+    failed = 0
+    database = config.DATABASE
+    print('   rows  old random  old popular  new random  new popular  pool load')
+    for count in (1000, 10000, 100000):
+        with tempfile.TemporaryDirectory() as tmp:
+            config.DATABASE = os.path.join(tmp, 'bench.sqlite')
+            db.snapshot.clear()
+            try:
+                await fill_poi(count)
+                started = time.perf_counter()
+                random_pois = await db.get_random_poi(6)
+                popular_pois = await db.get_popular_poi(9)
+                load = time.perf_counter() - started
+                # Popular POI can be buildings, but not deleted
+                wrong = [p.id for p in random_pois if p.tag in ('building', 'entrance')]
+                wrong.extend(p.id for p in random_pois + popular_pois if p.delete_reason)
+                if wrong or len(random_pois) != 6 or len(popular_pois) != 9:
+                    failed += 1
+                    print(f'Wrong choice: {len(random_pois)} random and {len(popular_pois)} '
+                          f'popular POI, filtered out but chosen: {wrong}')
+                timings = [
+                    await time_calls(old_random),
+                    await time_calls(old_popular),
+                    await time_calls(lambda: db.get_random_poi(6)),
+                    await time_calls(lambda: db.get_popular_poi(9)),
+                ]
+            finally:
+                await db.close()
+                config.DATABASE = database
+        print(f'{count:7}' + ''.join(f'{t * 1000:9.2f} ms' for t in timings) +
+              f'{load * 1000:8.1f} ms')
+    return failed
+
+
+def bench_random() -> int:
+    return asyncio.run(bench_random_async())
+
+
+BENCHMARKS = {
+    'addr': bench_addr,
+    'hours': bench_hours,
+    'random': bench_random,
+}
+
+
+def run():
+    names = sys.argv[2:] or list(BENCHMARKS)
+    failed = 0
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f'Unknown benchmark {name}, choose from: {", ".join(BENCHMARKS)}')
+            sys.exit(2)
+        print(f'== {name}')
+        failed += BENCHMARKS[name]()
+    if failed:
+        sys.exit(1)
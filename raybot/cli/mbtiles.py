@@ -0,0 +1,48 @@
+from raybot import config
+import os
+import sys
+import sqlite3
+
+
+def run():
+    if len(sys.argv) < 3:
+        print('Usage: {} mbtiles <tiles.mbtiles>'.format(sys.argv[0]))
+        print('Packs z/x/y.png tiles from the "tiles" directory into a single file.')
+        sys.exit(1)
+    if not os.path.isdir(config.TILES):
+        print(f'{config.TILES} is not a directory.')
+        sys.exit(2)
+    filename = sys.argv[2]
+    if os.path.exists(filename):
+        print(f'{filename} already exists.')
+        sys.exit(2)
+
+    count = 0
+    with sqlite3.connect(filename) as conn:
+        conn.execute("create table metadata (name text, value text)")
+        conn.execute("create table tiles (zoom_level integer, tile_column integer, "
+                     "tile_row integer, tile_data blob)")
+        conn.execute("create unique index tile_index on tiles "
+                     "(zoom_level, tile_column, tile_row)")
+        zooms = sorted([int(z) for z in os.listdir(config.TILES) if z.isdecimal()])
+        for zoom in zooms:
+            zpath = os.path.join(config.TILES, str(zoom))
+            for x in os.listdir(zpath):
+                if not x.isdecimal():
+                    continue
+                for name in os.listdir(os.path.join(zpath, x)):
+                    y = name.rsplit('.', 1)[0]
+                    if not name.endswith('.png') or not y.isdecimal():
+                        continue
+                    with open(os.path.join(zpath, x, name), 'rb') as f:
+                        data = f.read()
+                    # MBTiles use TMS numbering, where rows go from the south
+                    conn.execute("insert into tiles values (?, ?, ?, ?)",
+                                 (zoom, int(x), (1 << zoom) - 1 - int(y), data))
+                    count += 1
+        conn.executemany("insert into metadata values (?, ?)", [
+            ('name', 'raybot'), ('format', 'png'),
+            ('minzoom', str(zooms[0] if zooms else 0)),
+            ('maxzoom', str(zooms[-1] if zooms else 0)),
+        ])
+    print(f'Packed {count} tiles. Set "tiles: {filename}" in config.yml to use them.')
@@ -0,0 +1,23 @@
+import asyncio
+import aiosqlite
+from raybot import config
+from raybot.model import migrations
+
+
+async def aiorun():
+    conn = await aiosqlite.connect(config.DATABASE)
+    try:
+        version = await migrations.get_version(conn)
+        if version == migrations.LATEST:
+            print(f'The database is up to date, version {version}.')
+        else:
+            print(f'Upgrading the database from version {version} to {migrations.LATEST}.')
+            await migrations.migrate(conn, version)
+            print('Done.')
+        await migrations.update_indexes(conn)
+    finally:
+        await conn.close()
+
+
+def run():
+    asyncio.run(aiorun())
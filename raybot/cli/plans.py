@@ -0,0 +1,90 @@
+import asyncio
+import sys
+from raybot import config
+from raybot.model import db, Location
+
+
+# These read whole tables by design
+SCANS_ALLOWED = {'get_random_poi', 'get_file_ids', 'poi_with_empty_value'}
+
+
+def get_checks():
+    """Returns a list of (name, coroutine) for every read function in db."""
+    return [
+        ('get_poi_by_id', db.get_poi_by_id(1)),
+        ('get_poi_by_ids', db.get_poi_by_ids([1, 2])),
+        ('get_poi_by_house', db.get_poi_by_house('house')),
+        ('get_poi_by_house', db.get_poi_by_house('house', '-')),
+        ('get_poi_by_house', db.get_poi_by_house('house', '2')),
+        ('get_poi_by_tag', db.get_poi_by_tag('amenity=cafe')),
+        ('get_poi_by_key', db.get_poi_by_key('house')),
+        ('get_floors_by_house', db.get_floors_by_house('house')),
+        ('count_stars', db.count_stars(1, 1)),
+        ('stars_for_poi_list', db.stars_for_poi_list(1, [1, 2])),
+        ('get_starred_poi', db.get_starred_poi(1)),
+        ('get_popular_poi', db.get_popular_poi()),
+        ('get_poi_around', db.get_poi_around(Location(lon=27.6, lat=53.9))),
+        ('find_poi', db.find_poi('test')),
+        ('find_poi_fallback', db.find_poi_fallback(['test', 'query'])),
+        ('poi_with_empty_value', db.poi_with_empty_value('hours')),
+        ('get_roles', db.get_roles(1)),
+        ('get_role_users', db.get_role_users('moderator')),
+        ('get_entrances', db.get_entrances('house')),
+        ('find_file_ids', db.find_file_ids({'photo': 1})),
+        ('get_file_ids', db.get_file_ids()),
+        ('find_path_for_file_id', db.find_path_for_file_id('file_id')),
+        ('get_houses', db.get_houses()),
+        ('get_queue', db.get_queue()),
+        ('get_last_audit', db.get_last_audit()),
+        ('get_queue_msg', db.get_queue_msg(1)),
+        ('get_next_unchecked', db.get_next_unchecked()),
+        ('get_last_poi', db.get_last_poi()),
+        ('get_last_deleted', db.get_last_deleted()),
+        ('get_random_poi', db.get_random_poi()),
+        ('get_stats', db.get_stats()),
+        ('get_poi_ages', db.get_poi_ages([1, 2])),
+        ('get_fsm', db.get_fsm(1, 1, 0)),
+    ]
+
+
+def find_scans(plan) -> list:
+    """Returns plan lines that read a whole table."""
+    return [row[3] for row in plan
+            if row[3].startswith('SCAN ') and ' USING ' not in row[3]
+            and 'VIRTUAL TABLE' not in row[3] and row[3] != 'SCAN CONSTANT ROW']
+
+
+async def aiorun() -> int:
+    db.snapshot.enabled = False
+    # Trace every query on a single connection
+    config.DB_READERS = 0
+    conn = await db.get_db()
+    statements = []
+    await conn.set_trace_callback(statements.append)
+    queries = []
+    for name, coro in get_checks():
+        statements.clear()
+        await coro
+        # Skipping internal queries of the full-text search module
+        queries.extend((name, s) for s in statements if s.lstrip().lower().startswith(
+            ('select', 'with')) and "'main'." not in s)
+    await conn.set_trace_callback(None)
+
+    failed = 0
+    for name, query in queries:
+        cursor = await conn.execute('explain query plan ' + query)
+        scans = find_scans(await cursor.fetchall())
+        if scans:
+            allowed = name in SCANS_ALLOWED
+            if not allowed:
+                failed += 1
+            print(f'{"Allowed" if allowed else "FULL SCAN"} in {name}: {", ".join(scans)}')
+            print(f'    {query}')
+    await db.close()
+    print(f'Checked {len(queries)} queries, {failed} with unexpected full scans.')
+    return failed
+
+
+def run():
+    if asyncio.run(aiorun()):
+        sys.exit(1)
@@ -23,8 +23,9 @@ def run():
 
     logging.basicConfig(level=logging.INFO)
     fp = get_map(locations)
+    if not fp:
+        print('Could not render a map: are there tiles?')
+        sys.exit(3)
     filename = 'test_map.jpg' if len(sys.argv) < 4 else sys.argv[3]
     with open(filename, 'wb') as f:
-        data = fp.read()
-        f.write(data)
-    fp.close()
+        f.write(fp.getvalue())
@@ -1,13 +1,14 @@
 from raybot import config
 from raybot.model import db, Location
 from raybot.bot import dp
-from raybot.util import split_tokens, has_keyword, get_user, h, HTML, get_buttons, prune_users, tr
+from raybot.util import (
+    split_tokens, find_predefined, get_user, h, HTML, get_buttons, prune_users, tr
+)
+from raybot.util.log import sink
+from raybot.util.photos import photo_registry
 from raybot.actions.addr import test_address
 from raybot.actions.poi import PoiState, print_poi, print_poi_list
 from raybot.actions.messages import process_reply
-import os
-import csv
-import logging
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 
@@ -43,12 +44,7 @@ async def help(message: types.Message, state: FSMContext):
 def write_search_log(message, tokens, result):
     row = [message.date.strftime('%Y-%m-%d'), message.text.strip(),
            None if not tokens else ' '.join(tokens), result]
-    try:
-        with open(os.path.join(config.LOGS, 'search.log'), 'a') as f:
-            w = csv.writer(f, delimiter='\t')
-            w.writerow(row)
-    except IOError:
-        logging.warning('Failed to write log line: %s', row)
+    sink.write('search.log', row)
 
 
 @dp.message_handler(state='*')
@@ -88,19 +84,11 @@ async def process(message: types.Message, state: FSMContext):
 async def process_query(message, state, tokens):
     query = ' '.join(tokens)
     pois = await db.find_poi(query)
-    if not pois and len(tokens) > 2:
-        # Attempt a search with one less tokens
-        for ti in range(len(tokens)):
-            query = ' '.join(tokens[i] for i in range(len(tokens)) if i != ti)
-            new_pois = await db.find_poi(query)
-            if new_pois and (not pois or len(pois) > len(new_pois)):
-                pois = new_pois
     if not pois and len(tokens) > 1:
-        # Attemt a search with just one token
-        for t in tokens:
-            new_pois = await db.find_poi(t)
-            if new_pois and (not pois or len(pois) > len(new_pois)):
-                pois = new_pois
+        # Attempt a search with one less token, and then with just one token
+        fallback_query, pois = await db.find_poi_fallback(tokens)
+        if pois:
+            query = fallback_query
 
     if len(pois) == 1:
         write_search_log(message, tokens, f'poi {pois[0].id}')
@@ -110,8 +98,8 @@ async def process_query(message, state, tokens):
     elif len(pois) > 1:
         write_search_log(message, tokens, f'{len(pois)} results')
         await PoiState.poi_list.set()
-        await state.set_data({'query': query, 'poi': [p.id for p in pois]})
-        await print_poi_list(message.from_user, message.text, pois)
+        await state.set_data({'query': query, 'poi': [p.id for p in pois], 'ranked': True})
+        await print_poi_list(message.from_user, message.text, pois, ranked=True)
     else:
         write_search_log(message, tokens, 'not found')
         new_kbd = types.InlineKeyboardMarkup().add(
@@ -128,39 +116,31 @@ async def process_query(message, state, tokens):
 async def test_predefined(message, tokens) -> bool:
     all_tokens = ' '.join(tokens)
     query = message.text.lower().strip()
-    for resp in config.RESP['responses']:
-        kw = [k.lower() for k in resp['keywords']]
-        if has_keyword(all_tokens, kw) or has_keyword(query, kw):
-            if 'role' in resp:
-                user = await get_user(message.from_user)
-                if resp['role'] not in user.roles:
-                    continue
-            content = resp.get('name', '')
-            photo = None
-            if 'photo' in resp:
-                photo_path = os.path.join(config.PHOTOS, resp['photo'])
-                if os.path.exists(photo_path):
-                    file_ids = await db.find_file_ids(
-                        {resp['photo']: os.path.getsize(photo_path)})
-                    if file_ids:
-                        photo = file_ids[resp['photo']]
-                    else:
-                        photo = types.InputFile(photo_path)
-            if 'message' in resp:
-                if content:
-                    content += '\n\n'
-                content += resp['message']
-            kbd = get_buttons(resp.get('buttons'))
-
-            if photo:
-                msg = await message.answer_photo(
-                    photo, caption=content, parse_mode=HTML, reply_markup=kbd)
-                if not isinstance(photo, str):
-                    file_id = msg.photo[0].file_id
-                    await db.store_file_id(resp['photo'], os.path.getsize(photo_path), file_id)
+    for resp in find_predefined(all_tokens, query):
+        if resp.role:
+            user = await get_user(message.from_user)
+            if resp.role not in user.roles:
+                continue
+        content = resp.content
+        photo = None
+        photo_size = None if not resp.photo else photo_registry.size(resp.photo)
+        if photo_size is not None:
+            file_ids = await photo_registry.find({resp.photo: photo_size})
+            if file_ids:
+                photo = file_ids[resp.photo]
             else:
-                await message.answer(content, parse_mode=HTML, reply_markup=kbd)
-            return True
+                photo = types.InputFile(resp.photo_path)
+        kbd = get_buttons(resp.buttons)
+
+        if photo:
+            msg = await message.answer_photo(
+                photo, caption=content, parse_mode=HTML, reply_markup=kbd)
+            if not isinstance(photo, str):
+                file_id = msg.photo[0].file_id
+                await photo_registry.store(resp.photo, photo_size, file_id)
+        else:
+            await message.answer(content, parse_mode=HTML, reply_markup=kbd)
+        return True
     return False
 
 
@@ -1,9 +1,12 @@
 from raybot import config
 from raybot.model import db, POI, Location
 from raybot.bot import bot, dp
-from raybot.util import h, HTML, split_tokens, get_buttons, get_map, get_user, tr, DOW
+from raybot.util import (
+    h, HTML, split_tokens, get_buttons, get_map_photo, store_map_file_id, get_user, tr, DOW
+)
 from raybot.actions.poi import POI_EDIT_CB, POI_LIST_CB
 from raybot.actions.messages import broadcast_str, broadcast
+from raybot.util.photos import photo_registry
 import re
 import os
 import logging
@@ -352,13 +355,14 @@ async def suggest_photo_out(message: types.Message, state: FSMContext):
     kbd = types.InlineKeyboardMarkup(row_width=5)
     media = types.MediaGroup()
     for i, photo in enumerate(photos, 1):
-        path = os.path.join(config.PHOTOS, photo + '.jpg')
-        if os.path.exists(path):
-            file_ids = await db.find_file_ids({photo: os.path.getsize(path)})
+        size = photo_registry.size(photo + '.jpg')
+        if size is not None:
+            file_ids = await photo_registry.find({photo: size})
             if photo in file_ids:
                 media.attach_photo(file_ids[photo])
             else:
-                media.attach_photo(types.InputFile(path))
+                media.attach_photo(types.InputFile(
+                    os.path.join(config.PHOTOS, photo + '.jpg')))
             kbd.insert(types.InlineKeyboardButton(
                 str(i), callback_data=PHOTO_CB.new(name=photo, which='out')))
     kbd.insert(types.InlineKeyboardButton(
@@ -390,7 +394,7 @@ async def upload_photo(message: types.Message, state: FSMContext):
         if not os.path.exists(path):
             await message.answer(tr(('editor', 'upload_fail')))
             return
-        await db.store_file_id(name, os.path.getsize(path), file_id)
+        await photo_registry.store(name, os.path.getsize(path), file_id)
         downloaded = True
 
     kbd = types.InlineKeyboardMarkup().add(
@@ -531,7 +535,7 @@ async def edit_house(message: types.Message, state: FSMContext):
     houses = houses[:3]
 
     # Prepare the map
-    map_file = get_map([h.location for h in houses], ref=poi.location)
+    map_key, map_photo = await get_map_photo([h.location for h in houses], ref=poi.location)
     # Prepare the keyboard
     kbd = types.InlineKeyboardMarkup(row_width=1)
     for i, house in enumerate(houses, 1):
@@ -543,10 +547,11 @@ async def edit_house(message: types.Message, state: FSMContext):
 
     # Finally send the reply
     await delete_msg(message, state)
-    if map_file:
-        await message.answer_photo(types.InputFile(map_file.name),
-                                   caption=tr(('editor', 'house')), reply_markup=kbd)
-        map_file.close()
+    if map_photo:
+        msg = await message.answer_photo(map_photo, caption=tr(('editor', 'house')),
+                                         reply_markup=kbd)
+        if not isinstance(map_photo, str) and msg.photo:
+            store_map_file_id(map_key, msg.photo[-1].file_id)
     else:
         await message.answer(tr(('editor', 'house')), reply_markup=kbd)
 
@@ -824,7 +829,6 @@ async def store_attr(message: types.Message, state: FSMContext):
         poi.location = loc
     elif attr == 'hours':
         if value == '-':
-            poi.hours = None
             poi.hours_src = None
         else:
             try:
@@ -834,7 +838,6 @@ async def store_attr(message: types.Message, state: FSMContext):
                                      reply_markup=cancel_attr_kbd())
                 return
             poi.hours_src = hours
-            poi.hours = hoh.OHParser(hours)
     elif attr == 'phones':
         if not value or value == '-':
             poi.phones = []
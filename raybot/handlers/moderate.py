@@ -9,6 +9,9 @@ from raybot import config
 from raybot.model import db
 from raybot.bot import bot, dp
 from raybot.util import h, HTML, get_user, forget_user, tr
+from raybot.util.photos import photo_registry
+from raybot.util.map import cached_tiles, rendered_maps, map_file_ids
+from raybot.util.session import sessions
 from raybot.actions import transfer
 from raybot.actions.poi import print_poi, POI_EDIT_CB, print_poi_list, PoiState
 from typing import Dict
@@ -254,6 +257,21 @@ async def print_audit(user: types.User):
     await bot.send_message(user.id, content, disable_web_page_preview=True)
 
 
+async def print_cache_stats(user: types.User):
+    lines = [tr(('admin_caches', 'msg')) + ':',
+             tr(('admin_caches', 'snapshot'), **db.snapshot.stats())]
+    tiles = cached_tiles.stats()
+    tiles['kb'] = tiles['bytes'] // 1024
+    tiles['hit_rate'] = f'{tiles["hit_rate"]:.0%}'
+    lines.append(tr(('admin_caches', 'tiles'), **tiles))
+    for key, cache in (('maps', rendered_maps), ('file_ids', map_file_ids)):
+        stats = cache.stats()
+        lines.append(tr(('admin_caches', key), kb=stats['bytes'] // 1024, **stats))
+    stats = sessions.stats()
+    lines.append(tr(('admin_caches', 'sessions'), kb=stats['bytes'] // 1024, **stats))
+    await bot.send_message(user.id, h('\n'.join(lines)))
+
+
 async def dedup_photos():
     def hashall(photos):
         result = defaultdict(list)
@@ -294,8 +312,10 @@ async def dedup_photos():
             for photo in ph[1:]:
                 path = os.path.join(config.PHOTOS, photo + '.jpg')
                 os.remove(path)
+                photo_registry.forget(photo + '.jpg')
                 removed += 1
     await conn.commit()
+    db.snapshot.clear()
     return removed
 
 
@@ -308,17 +328,18 @@ async def delete_unused_photos():
         if 'photo' in predef:
             photos.discard(predef['photo'].rsplit('.', 1)[0])
 
-    conn = await db.get_db()
-    cursor = await conn.execute(
+    conn = await db.get_reader()
+    rows = await conn.execute_fetchall(
         "select name, photo_out, photo_in from poi where photo_out is not null "
         "or photo_in is not null")
-    async for row in cursor:
+    for row in rows:
         for c in (1, 2):
             if row[c]:
                 photos.discard(row[c])
     for name in photos:
         path = os.path.join(config.PHOTOS, name + '.jpg')
         os.remove(path)
+        photo_registry.forget(name + '.jpg')
     return len(photos)
 
 
@@ -382,6 +403,8 @@ async def admin_info(message: types.Message):
                                               callback_data=ADMIN_CB.new(action='unused')))
         kbd.insert(types.InlineKeyboardButton(tr(('admin_menu', 'base')),
                                               callback_data=ADMIN_CB.new(action='base')))
+        kbd.insert(types.InlineKeyboardButton(tr(('admin_menu', 'caches')),
+                                              callback_data=ADMIN_CB.new(action='caches')))
     kbd.insert(types.InlineKeyboardButton(tr(('admin_menu', 'audit')),
                                           callback_data=ADMIN_CB.new(action='audit')))
     kbd.insert(types.InlineKeyboardButton(tr(('admin_menu', 'reindex')),
@@ -425,6 +448,8 @@ async def admin_command(query: types.CallbackQuery, callback_data: Dict[str, str
         await bot.send_message(query.from_user.id, tr(('admin_menu', 'del_unused'), cnt))
     elif action == 'audit':
         await print_audit(user)
+    elif action == 'caches' and user.id == config.ADMIN:
+        await print_cache_stats(user)
     elif action == 'mis-house':
         await print_missing_value(user, 'house', state)
     elif action == 'mis-photo':
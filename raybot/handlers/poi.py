@@ -22,6 +22,7 @@ async def all_pois(query: types.CallbackQuery, callback_data: Dict[str, str],
         data = await state.get_data()
         txt = data['query']
         pois = await db.get_poi_by_ids(data['poi'])
+        ranked = data.get('ranked', False)
     else:
         txt = callback_data['query']
         ids = callback_data['ids']
@@ -30,7 +31,9 @@ async def all_pois(query: types.CallbackQuery, callback_data: Dict[str, str],
             pois = await db.find_poi(' '.join(tokens))
         else:
             pois = await db.get_poi_by_ids(unpack_ids(ids))
-    await print_poi_list(query.from_user, txt, pois, True)
+        # Search results are sorted by relevance, and packed ids are in the shown order
+        ranked = True
+    await print_poi_list(query.from_user, txt, pois, True, ranked=ranked)
 
 
 @dp.callback_query_handler(POI_LIST_CB.filter(), state='*')
@@ -172,4 +175,5 @@ async def set_loc(message: types.Message, state: FSMContext):
     await save_location(message)
     data = await state.get_data()
     pois = await db.get_poi_by_ids(data['poi'])
-    await print_poi_list(message.from_user, data['query'], pois)
+    await print_poi_list(message.from_user, data['query'], pois,
+                         ranked=data.get('ranked', False))
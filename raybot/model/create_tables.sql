@@ -8,7 +8,7 @@ create table poi (
   updated timestamp not null default current_timestamp,
   needs_check boolean not null default 0,
   description text,
-  keywords text, -- same as in poisearch table (see below)
+  keywords text, -- same as in poisearch table (see poisearch.sql)
   photo_out text,
   photo_in text,
   tag text, -- OSM key=value
@@ -26,10 +26,6 @@ create table poi (
 );
 create unique index poi_str_id_idx on poi (str_id);
 
-create virtual table poisearch using fts3(name, keywords, tag, tokenize=unicode61);
--- When modifying poi, also modify rows in poisearch, using the "docid" column.
--- Typical search: select * from poi where rowid in (select rowid from poisearch where poisearch match 'tokens')
-
 create table queue (
   id integer primary key,
   user_id integer not null,
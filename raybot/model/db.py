@@ -1,86 +1,161 @@
 import aiosqlite
-import logging
-import os
+import asyncio
+import pathlib
 import json
+import random
 from raybot import config
 from .entities import POI, UserInfo, QueueMessage, Location
+from .snapshot import PoiSnapshot
+from . import migrations
 from typing import List, Dict, Tuple
+from math import radians, cos
 
 
 _db = None
+_readers: List[aiosqlite.Connection] = []
+_readers_lock = asyncio.Lock()
+_next_reader = 0
+MAX_COMPOUND_SELECT = 200
+snapshot = PoiSnapshot(config.POI_CACHE)
+
+
+async def setup_connection(conn, writer: bool):
+    conn.row_factory = aiosqlite.Row
+    for k, v in config.DB_PRAGMAS.items():
+        # Read-only connections can't change the journal, and don't write
+        if writer or k not in ('journal_mode', 'synchronous'):
+            await conn.execute(f'pragma {k} = {v}')
 
 
 async def get_db():
+    """Returns the connection for writing. Use get_reader() for queries."""
     global _db
     if _db is not None and _db._running:
         return _db
     _db = await aiosqlite.connect(config.DATABASE)
-    _db.row_factory = aiosqlite.Row
-    exists_query = ("select count(*) from sqlite_master where type = 'table' "
-                    "and name in ('poi', 'poisearch', 'roles')")
-    async with _db.execute(exists_query) as cursor:
-        has_tables = (await cursor.fetchone())[0] == 3
-    if not has_tables:
-        logging.info('Creating tables')
-        with open(os.path.join(os.path.dirname(__file__), 'create_tables.sql'), 'r') as f:
-            queries = [q.strip() for q in f.read().split(';')]
-        for q in queries:
-            if q:
-                await _db.execute(q)
+    await setup_connection(_db, True)
+    version = await migrations.get_version(_db)
+    if version != migrations.LATEST:
+        await migrations.migrate(_db, version)
+    await migrations.update_indexes(_db)
     return _db
 
 
+async def get_reader():
+    """Returns one of read-only connections, so that queries are not
+    blocked by writes. Falls back to the writing connection when
+    there are no readers configured. Use execute_fetchall() on it: while
+    a statement is unfinished, the connection stays in a read transaction,
+    and other queries on it would see data from before later commits."""
+    global _next_reader
+    if config.DB_READERS <= 0:
+        return await get_db()
+    async with _readers_lock:
+        if not _readers or not all(r._running for r in _readers):
+            await close_readers()
+            # Upgrade the database first
+            await get_db()
+            uri = pathlib.Path(config.DATABASE).absolute().as_uri() + '?mode=ro'
+            for _ in range(config.DB_READERS):
+                conn = await aiosqlite.connect(uri, uri=True)
+                await setup_connection(conn, False)
+                _readers.append(conn)
+    _next_reader = (_next_reader + 1) % len(_readers)
+    return _readers[_next_reader]
+
+
+async def close_readers():
+    global _readers
+    for conn in _readers:
+        if conn._running:
+            await conn.close()
+    _readers = []
+
+
 async def close():
+    await close_readers()
     if _db is not None and _db._running:
         await _db.close()
 
 
 async def get_poi_by_id(poi_id: int) -> POI:
+    poi = snapshot.get(poi_id)
+    if poi:
+        return poi
     query = ("select poi.*, h.name as h_address from poi "
              "left join poi h on h.str_id = poi.house where poi.id = ?")
-    db = await get_db()
-    cursor = await db.execute(query, (poi_id,))
-    row = await cursor.fetchone()
-    return None if not row else POI(row)
-
-
-async def get_poi_by_ids(poi_ids: List[int]) -> POI:
-    query = "select * from poi where id in ({})".format(','.join('?' * len(poi_ids)))
-    db = await get_db()
-    cursor = await db.execute(query, tuple(poi_ids))
-    return [POI(r) async for r in cursor]
+    generation = snapshot.generation
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (poi_id,))
+    return None if not rows else snapshot.put(POI(rows[0]), generation)
+
+
+async def get_poi_by_ids(poi_ids: List[int]) -> List[POI]:
+    """Returns POI in the order of poi_ids, skipping missing ones."""
+    pois = {}
+    for poi_id in poi_ids:
+        poi = snapshot.get(poi_id)
+        if poi:
+            pois[poi.id] = poi
+    missing = [i for i in poi_ids if i not in pois]
+    if missing:
+        query = ("select poi.*, h.name as h_address from poi "
+                 "left join poi h on h.str_id = poi.house "
+                 "where poi.id in ({})".format(','.join('?' * len(missing))))
+        generation = snapshot.generation
+        db = await get_reader()
+        rows = await db.execute_fetchall(query, tuple(missing))
+        for r in rows:
+            pois[r['id']] = snapshot.put(POI(r), generation)
+    return [pois[k] for k in dict.fromkeys(poi_ids) if k in pois]
 
 
 async def get_poi_by_house(house: str, floor: str = None) -> POI:
     """Pass '-' for floor to query only empty floors."""
-    query = ("select * from poi where house = ? and in_index and delete_reason is null "
-             "and (tag is null or tag not in ('entrance', 'building'))")
+    pois = snapshot.get_list(('house', house, floor))
+    if pois is not None:
+        return pois
+    query = ("select poi.*, h.name as h_address from poi "
+             "left join poi h on h.str_id = poi.house "
+             "where poi.house = ? and poi.in_index and poi.delete_reason is null "
+             "and (poi.tag is null or poi.tag not in ('entrance', 'building'))")
     if floor == '-':
-        query += " and flor is null"
+        query += " and poi.flor is null"
         args = (house, )
-    if floor:
-        query += " and flor = ?"
+    elif floor:
+        query += " and poi.flor = ?"
         args = (house, floor)
     else:
         args = (house,)
-    db = await get_db()
-    cursor = await db.execute(query, args)
-    return [POI(r) async for r in cursor]
+    generation = snapshot.generation
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, args)
+    return snapshot.put_list(('house', house, floor), [POI(r) for r in rows], generation)
 
 
 async def get_poi_by_tag(tag: str) -> POI:
-    query = "select * from poi where tag = ? and delete_reason is null"
-    db = await get_db()
-    cursor = await db.execute(query, (tag,))
-    return [POI(r) async for r in cursor]
+    pois = snapshot.get_list(('tag', tag))
+    if pois is not None:
+        return pois
+    query = ("select poi.*, h.name as h_address from poi "
+             "left join poi h on h.str_id = poi.house "
+             "where poi.tag = ? and poi.delete_reason is null")
+    generation = snapshot.generation
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (tag,))
+    return snapshot.put_list(('tag', tag), [POI(r) for r in rows], generation)
 
 
 async def get_poi_by_key(str_id: str) -> POI:
-    query = "select * from poi where str_id = ?"
-    db = await get_db()
-    cursor = await db.execute(query, (str_id,))
-    row = await cursor.fetchone()
-    return None if not row else POI(row)
+    poi = snapshot.get_by_key(str_id)
+    if poi:
+        return poi
+    query = ("select poi.*, h.name as h_address from poi "
+             "left join poi h on h.str_id = poi.house where poi.str_id = ?")
+    generation = snapshot.generation
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (str_id,))
+    return None if not rows else snapshot.put(POI(rows[0]), generation)
 
 
 async def get_floors_by_house(house: str) -> POI:
@@ -89,58 +164,50 @@ async def get_floors_by_house(house: str) -> POI:
     query = ("select distinct flor from poi where house = ? and in_index "
              "and delete_reason is null "
              "and (tag is null or tag not in ('entrance', 'building'))")
-    db = await get_db()
-    cursor = await db.execute(query, (house,))
-    return [r[0] async for r in cursor]
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (house,))
+    return [r[0] for r in rows]
 
 
 async def count_stars(user_id: int, poi_id: int) -> Tuple[int, bool]:
     """Returns start count and whether the user have given a star."""
-    query = "select count(*), user_id = ? from stars where poi_id = ? group by user_id = ?"
-    db = await get_db()
-    cursor = await db.execute(query, (user_id, poi_id, user_id))
-    rows = await cursor.fetchall()
-    has_users = len(rows) > 1 or (rows and rows[0][1] == 1)
-    return sum((r[0] for r in rows)), has_users
+    query = ("select (select stars from poi_stars where poi_id = ?), "
+             "exists (select 1 from stars where poi_id = ? and user_id = ?)")
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (poi_id, poi_id, user_id))
+    row = rows[0]
+    return row[0] or 0, row[1] == 1
 
 
 async def stars_for_poi_list(user_id: int, poi_ids: List[int]) -> List[Tuple[int, bool]]:
-    query = ("select poi_id, count(*), user_id = ? from stars where poi_id in ({}) "
-             "group by 1, user_id = ?".format(','.join('?' * len(poi_ids))))
-    db = await get_db()
-    cursor = await db.execute(query, (user_id, *poi_ids, user_id))
-    result = {}
-    async for row in cursor:
-        if row[0] not in result:
-            result[row[0]] = (row[1], row[2] == 1)
-        else:
-            result[row[0]] = (row[1] + result[row[0]][0], True)
-    return result
+    query = ("select poi_id, stars, exists (select 1 from stars s "
+             "where s.poi_id = poi_stars.poi_id and s.user_id = ?) "
+             "from poi_stars where poi_id in ({})".format(','.join('?' * len(poi_ids))))
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (user_id, *poi_ids))
+    return {row[0]: (row[1], row[2] == 1) for row in rows}
 
 
 async def get_starred_poi(user_id: int) -> List[POI]:
     query = ("select * from poi where delete_reason is null and "
              "id in (select poi_id from stars where user_id = ?)")
-    db = await get_db()
-    cursor = await db.execute(query, (user_id,))
-    return [POI(r) async for r in cursor]
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (user_id,))
+    return [POI(r) for r in rows]
 
 
 async def get_popular_poi(count: int = 10, min_stars: int = 2, top: int = 30) -> List[POI]:
-    # TODO: Choose only among top N pois by stars.
-    # query = ("""\
-    # with popular as (select poi_id, count(*) as stars from stars
-    # group by poi_id having count(*) >= ? order by stars desc limit {})
-    # select * from poi left join popular on poi_id = poi.id
-    # where delete_reason is null and stars is not null
-    # order by random() limit {}""".format(top, count))
-
-    query = ("select * from poi where delete_reason is null and "
-             "id in (select poi_id from stars group by poi_id having count(*) >= ?) "
-             "order by random() limit {}".format(count))
-    db = await get_db()
-    cursor = await db.execute(query, (min_stars,))
-    return [POI(r) async for r in cursor]
+    """Chooses random POI among top N by stars."""
+    key = ('popular', min_stars, top)
+    ids = snapshot.get_pool(key)
+    if ids is None:
+        query = ("select poi_id from poi_stars join poi on poi.id = poi_id "
+                 "where stars >= ? and delete_reason is null order by stars desc limit ?")
+        generation = snapshot.generation
+        db = await get_reader()
+        rows = await db.execute_fetchall(query, (min_stars, top))
+        ids = snapshot.put_pool(key, [r[0] for r in rows], generation)
+    return await get_poi_by_ids(random.sample(ids, min(count, len(ids))))
 
 
 async def set_star(user_id: int, poi_id: int, star: bool):
@@ -151,42 +218,99 @@ async def set_star(user_id: int, poi_id: int, star: bool):
         query = "delete from stars where poi_id = ? and user_id = ?"
     await db.execute(query, (poi_id, user_id))
     await db.commit()
+    snapshot.forget_pools('popular')
 
 
 async def get_poi_around(loc: Location, count: int = 40, floor: str = None,
                          dist: int = 100) -> List[POI]:
-    # We don't have a spatial index, so we're just inventing a bounding box
-    # approximately 100 × 100 meters.
-    args = []
+    """Returns up to count nearest POI within dist meters, closest first."""
+    # Meters in one degree of latitude and longitude around the location.
+    # Same approximation as in Location.distance().
+    klat = radians(1) * 6371e3
+    klon = klat * cos(radians(loc.lat))
+    args = [loc.lon, loc.lon, klon * klon, loc.lat, loc.lat, klat * klat,
+            loc.lon - dist / klon, loc.lon + dist / klon,
+            loc.lat - dist / klat, loc.lat + dist / klat]
     if floor == '-':
-        qfloor = 'flor is null and'
+        qfloor = 'and flor is null'
     elif floor is not None:
-        qfloor = 'flor = ? and'
+        qfloor = 'and flor = ?'
         args.append(floor)
     else:
         qfloor = ''
-    query = (f"select * from poi where {qfloor} "
-             "lat > ? and lat < ? and lon > ? and lon < ? "
-             "and (tag is null or tag not in ('building', 'entrance')) "
-             "and delete_reason is null")
-    radius = 0.001
-    args.extend([loc.lat - radius, loc.lat + radius, loc.lon - radius, loc.lon + radius])
-    db = await get_db()
-    cursor = await db.execute(query, tuple(args))
-    pois = [POI(r) async for r in cursor]
-    pois = sorted([p for p in pois if loc.distance(p.location) <= dist],
-                  key=lambda p: loc.distance(p.location))
-    return pois[:count]
+    args.extend([dist * dist, count])
+    query = ("select * from (select poi.*, "
+             "(lon - ?) * (lon - ?) * ? + (lat - ?) * (lat - ?) * ? as dist2 "
+             "from poi_rtree r join poi on poi.id = r.id "
+             "where r.maxlon >= ? and r.minlon <= ? and r.maxlat >= ? and r.minlat <= ? "
+             f"{qfloor} and (tag is null or tag not in ('building', 'entrance')) "
+             "and delete_reason is null) where dist2 <= ? order by dist2 limit ?")
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, tuple(args))
+    return [POI(r) for r in rows]
+
+
+def fts_query(keywords: str) -> str:
+    """Quotes every token, so that punctuation is not parsed as FTS5 syntax.
+    The last token is also matched as a prefix, using the prefix index, so
+    that an unfinished word still finds something. Exact matches rank higher."""
+    tokens = keywords.split()
+    result = ['"{}"'.format(t.replace('"', '""')) for t in tokens]
+    if tokens and len(tokens[-1]) >= 2:
+        result[-1] = '({0} OR {0}*)'.format(result[-1])
+    return ' AND '.join(result)
 
 
 async def find_poi(keywords: str) -> List[POI]:
-    query = ("select poi.*, h.name as h_address from poi "
+    """Returns POI matching all keywords, most relevant first."""
+    # Weights are for name, keywords and tag columns.
+    query = ("select poi.*, h.name as h_address from poisearch "
+             "join poi on poi.id = poisearch.rowid "
              "left join poi h on h.str_id = poi.house "
-             "where poi.in_index and poi.delete_reason is null and "
-             "poi.rowid in (select docid from poisearch where poisearch match ?)")
-    db = await get_db()
-    cursor = await db.execute(query, (keywords,))
-    return [POI(r) async for r in cursor]
+             "where poisearch match ? and poi.in_index and poi.delete_reason is null "
+             "order by bm25(poisearch, 5.0, 3.0, 1.0)")
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (fts_query(keywords),))
+    return [POI(r) for r in rows]
+
+
+async def find_poi_fallback(tokens: List[str]) -> Tuple[str, List[POI]]:
+    """For when a search for all tokens fails. Tries queries with one token
+    left out, then with a single token, counting results for all of them
+    in as few statements as possible. Returns the query with the fewest results, and
+    the results."""
+    variants = []
+    if len(tokens) > 2:
+        variants.extend(' '.join(tokens[i] for i in range(len(tokens)) if i != ti)
+                        for ti in range(len(tokens)))
+    first_single = len(variants)
+    if len(tokens) > 1:
+        variants.extend(tokens)
+    if not variants:
+        return None, []
+
+    count_query = ("select ?, count(*) from poisearch join poi on poi.id = poisearch.rowid "
+                   "where poisearch match ? and poi.in_index and poi.delete_reason is null")
+    db = await get_reader()
+    counts = {}
+    # SQLite allows up to 500 terms in a compound select
+    for start in range(0, len(variants), MAX_COMPOUND_SELECT):
+        chunk = variants[start:start + MAX_COMPOUND_SELECT]
+        query = ' union all '.join([count_query] * len(chunk))
+        args = []
+        for i, v in enumerate(chunk, start):
+            args.extend([i, fts_query(v)])
+        rows = await db.execute_fetchall(query, tuple(args))
+        counts.update({r[0]: r[1] for r in rows})
+
+    for group in (range(first_single), range(first_single, len(variants))):
+        best = None
+        for i in group:
+            if counts.get(i) and (best is None or counts[best] > counts[i]):
+                best = i
+        if best is not None:
+            return variants[best], await find_poi(variants[best])
+    return None, []
 
 
 async def poi_with_empty_value(field: str, buildings: bool = False,
@@ -204,23 +328,23 @@ async def poi_with_empty_value(field: str, buildings: bool = False,
                  k=field, b='' if buildings else no_buildings,
                  e='' if entrances else no_entrances,
                  f=needs_floor if field == 'flor' else ''))
-    db = await get_db()
-    cursor = await db.execute(query)
-    return [POI(r) async for r in cursor]
+    db = await get_reader()
+    rows = await db.execute_fetchall(query)
+    return [POI(r) for r in rows]
 
 
 async def get_roles(user_id: int) -> List[str]:
     query = "select role from roles where user_id = ?"
-    db = await get_db()
-    cursor = await db.execute(query, (user_id,))
-    return [r[0] async for r in cursor]
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (user_id,))
+    return [r[0] for r in rows]
 
 
 async def get_role_users(role: str) -> List[UserInfo]:
     query = "select user_id, name from roles where role = ?"
-    db = await get_db()
-    cursor = await db.execute(query, (role,))
-    return [UserInfo(user_id=r[0], user_name=r[1]) async for r in cursor]
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (role,))
+    return [UserInfo(user_id=r[0], user_name=r[1]) for r in rows]
 
 
 async def add_user_to_role(user: UserInfo, role: str, added_by: UserInfo):
@@ -238,14 +362,21 @@ async def remove_user_from_role(user_id: int, role: str):
 
 
 async def get_entrances(building: str) -> List[str]:
-    query = "select str_id from poi where house = ? and tag = 'entrance'"
-    db = await get_db()
-    cursor = await db.execute(query, (building,))
-    return [r[0] async for r in cursor]
+    pois = snapshot.get_list(('entrances', building))
+    if pois is None:
+        query = ("select poi.*, h.name as h_address from poi "
+                 "left join poi h on h.str_id = poi.house "
+                 "where poi.house = ? and poi.tag = 'entrance'")
+        generation = snapshot.generation
+        db = await get_reader()
+        rows = await db.execute_fetchall(query, (building,))
+        pois = snapshot.put_list(('entrances', building),
+                                 [POI(r) for r in rows], generation)
+    return [p.key for p in pois]
 
 
 async def store_file_id(path: str, size: int, file_id: str) -> None:
-    query = "insert or ignore into file_ids (path, size, file_id) values (?, ?, ?)"
+    query = "insert or replace into file_ids (path, size, file_id) values (?, ?, ?)"
     db = await get_db()
     await db.execute(query, (path, size, file_id))
     await db.commit()
@@ -258,25 +389,31 @@ async def find_file_ids(paths: Dict[str, int]) -> Dict[str, str]:
         return {}
     query = "select path, size, file_id from file_ids where path in ({})".format(
         ','.join('?' * len(fpaths)))
-    db = await get_db()
-    cursor = await db.execute(query, tuple(fpaths))
-    return {r['path']: r['file_id'] async for r in cursor
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, tuple(fpaths))
+    return {r['path']: r['file_id'] for r in rows
             if r['size'] == paths[r['path']]}
 
 
+async def get_file_ids() -> Dict[str, Tuple[int, str]]:
+    """Returns a dict of "file path" -> (file size, file_id)."""
+    db = await get_reader()
+    rows = await db.execute_fetchall("select path, size, file_id from file_ids")
+    return {r[0]: (r[1], r[2]) for r in rows}
+
+
 async def find_path_for_file_id(file_id: str) -> str:
-    db = await get_db()
+    db = await get_reader()
     query = "select path from file_ids where file_id = ? limit 1"
-    cursor = await db.execute(query, (file_id,))
-    row = await cursor.fetchone()
-    return None if not row else row[0]
+    rows = await db.execute_fetchall(query, (file_id,))
+    return None if not rows else rows[0][0]
 
 
 async def get_houses() -> List[POI]:
     query = "select * from poi where str_id is not null and tag = 'building'"
-    db = await get_db()
-    cursor = await db.execute(query)
-    return [POI(r) async for r in cursor]
+    db = await get_reader()
+    rows = await db.execute_fetchall(query)
+    return [POI(r) for r in rows]
 
 
 async def insert_poi(user_id: int, poi: POI):
@@ -300,12 +437,13 @@ async def insert_poi(user_id: int, poi: POI):
 
     # Now update the search index
     tagkw = ' '.join(config.TAGS['tags'].get(poi.tag, [])) or None
-    query2 = ("insert into poisearch (docid, name, keywords, tag) "
+    query2 = ("insert into poisearch (rowid, name, keywords, tag) "
               "select rowid, replace(replace(name, 'Ё', 'Е'), 'ё', 'е') as name, "
               "  replace(keywords, 'ё', 'е') as keywords, ? "
               "from poi where id = ?")
     await db.execute(query2, (tagkw, rowid))
     await db.commit()
+    snapshot.forget(poi)
     return poi.id
 
 
@@ -323,11 +461,12 @@ async def update_poi(user_id: int, poi: POI):
     if 'keywords' in fields or 'tag' in fields or 'name' in fields:
         tagkw = ' '.join(config.TAGS['tags'].get(poi.tag, [])) or None
         query2 = ("update poisearch set keywords = ?, name = ?, "
-                  "tag = ? where docid = ?")
+                  "tag = ? where rowid = ?")
         kw = None if not poi.keywords else poi.keywords.lower().replace('ё', 'е')
         await db.execute(query2, (kw, poi.name.replace('Ё', 'Е').replace('ё', 'е'),
                                   tagkw, poi.id))
     await db.commit()
+    snapshot.forget(orig, poi)
     return poi.id
 
 
@@ -336,18 +475,20 @@ async def delete_poi(user_id: int, poi: POI, reason: str):
     query = ("insert into poi_audit (user_id, approved_by, poi_id, field, "
              "old_value, new_value) values (?, ?, ?, 'delete_reason', ?, ?)")
     await db.execute(query, (user_id, user_id, poi.id, None, reason))
-    await db.execute("delete from poisearch where docid = ?", (poi.id,))
+    await db.execute("delete from poisearch where rowid = ?", (poi.id,))
     await db.execute("update poi set delete_reason = ?, updated = current_timestamp "
                      "where id = ?", (reason, poi.id))
     await db.commit()
+    snapshot.forget(poi)
 
 
 async def delete_poi_forever(user_id: int, poi: POI):
     db = await get_db()
     save_audit(user_id, user_id, poi, None)
-    await db.execute("delete from poisearch where docid = ?", (poi.id,))
+    await db.execute("delete from poisearch where rowid = ?", (poi.id,))
     await db.execute("delete from poi where id = ?", (poi.id,))
     await db.commit()
+    snapshot.forget(poi)
 
 
 async def restore_poi(user_id: int, poi: POI):
@@ -358,11 +499,12 @@ async def restore_poi(user_id: int, poi: POI):
     await db.execute("update poi set delete_reason = null, updated = current_timestamp "
                      "where id = ?", (poi.id, ))
     tagkw = ' '.join(config.TAGS['tags'].get(poi.tag, [])) or None
-    query2 = "insert into poisearch (keywords, name, tag, docid) values (?, ?, ?, ?)"
+    query2 = "insert into poisearch (keywords, name, tag, rowid) values (?, ?, ?, ?)"
     kw = None if not poi.keywords else poi.keywords.lower().replace('ё', 'е')
     await db.execute(query2, (kw, poi.name.replace('Ё', 'Е').replace('ё', 'е'),
                               tagkw, poi.id))
     await db.commit()
+    snapshot.forget(poi)
 
 
 async def save_audit(user_id: int, approved_by: int, oldpoi: POI, poi: POI):
@@ -410,9 +552,9 @@ async def add_to_queue(user: UserInfo, poi: POI, message: str = None):
 
 async def get_queue(count: int = 1):
     query = f"select * from queue order by ts desc limit {count}"
-    db = await get_db()
-    cursor = await db.execute(query)
-    return [QueueMessage(r) async for r in cursor]
+    db = await get_reader()
+    rows = await db.execute_fetchall(query)
+    return [QueueMessage(r) for r in rows]
 
 
 async def get_last_audit(count: int = 10):
@@ -420,17 +562,16 @@ async def get_last_audit(count: int = 10):
              "from poi_audit a left join roles r on r.user_id = a.approved_by "
              "left join poi on poi.id = a.poi_id "
              f"order by a.ts desc limit {count}")
-    db = await get_db()
-    cursor = await db.execute(query)
-    return [QueueMessage(r) async for r in cursor]
+    db = await get_reader()
+    rows = await db.execute_fetchall(query)
+    return [QueueMessage(r) for r in rows]
 
 
 async def get_queue_msg(qid: int):
     query = f"select * from queue where id = ?"
-    db = await get_db()
-    cursor = await db.execute(query, (qid,))
-    row = await cursor.fetchone()
-    return None if not row else QueueMessage(row)
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (qid,))
+    return None if not rows else QueueMessage(rows[0])
 
 
 async def delete_queue(q: QueueMessage):
@@ -440,6 +581,7 @@ async def delete_queue(q: QueueMessage):
 
 
 async def apply_queue(user_id: int, q: QueueMessage):
+    orig = await get_poi_by_id(q.poi_id)
     db = await get_db()
     query = "update poi set {} = ?, updated = current_timestamp where id = ?".format(q.field)
     await db.execute(query, (q.new_value, q.poi_id))
@@ -447,23 +589,25 @@ async def apply_queue(user_id: int, q: QueueMessage):
              "old_value, new_value) values (?, ?, ?, ?, ?, ?)")
     if q.field == 'keywords':
         query2 = ("update poisearch set keywords = (select replace(keywords, 'ё', 'е') "
-                  "from poi where id = ?) where docid = ?")
+                  "from poi where id = ?) where rowid = ?")
         await db.execute(query2, (q.poi_id, q.poi_id))
     elif q.field == 'tag':
         tagkw = ' '.join(config.TAGS['tags'].get(q.new_value, [])) or None
-        query2 = "update poisearch set tag = ? where docid = ?"
+        query2 = "update poisearch set tag = ? where rowid = ?"
         await db.execute(query2, (tagkw, q.poi_id))
     await db.execute(query, (q.user_id, user_id, q.poi_id, q.field, q.old_value, q.new_value))
     await db.execute("delete from queue where id = ?", (q.id,))
     await db.commit()
+    snapshot.forget(orig or q.poi_id,
+                    house=q.new_value if q.field == 'house' else None,
+                    tag=q.new_value if q.field == 'tag' else None)
 
 
 async def get_next_unchecked():
     query = "select * from poi where needs_check order by created limit 1"
-    db = await get_db()
-    cursor = await db.execute(query)
-    row = await cursor.fetchone()
-    return None if not row else POI(row)
+    db = await get_reader()
+    rows = await db.execute_fetchall(query)
+    return None if not rows else POI(rows[0])
 
 
 async def validate_poi(poi_id: int):
@@ -471,76 +615,83 @@ async def validate_poi(poi_id: int):
     db = await get_db()
     await db.execute(query, (poi_id,))
     await db.commit()
+    snapshot.forget(poi_id)
 
 
 async def get_last_poi(count: int = 1):
-    db = await get_db()
     query = ("select * from poi where delete_reason is null "
              f"order by created desc limit {count}")
-    db = await get_db()
-    cursor = await db.execute(query)
-    return [POI(r) async for r in cursor]
+    db = await get_reader()
+    rows = await db.execute_fetchall(query)
+    return [POI(r) for r in rows]
 
 
 async def get_last_deleted(count: int = 1):
-    db = await get_db()
     query = ("select * from poi where delete_reason is not null "
              f"order by updated desc limit {count}")
-    db = await get_db()
-    cursor = await db.execute(query)
-    return [POI(r) async for r in cursor]
+    db = await get_reader()
+    rows = await db.execute_fetchall(query)
+    return [POI(r) for r in rows]
 
 
 async def get_random_poi(count: int = 10):
-    db = await get_db()
-    query = ("select * from poi where id in (select id from poi "
-             "where (tag is null or tag not in ('building', 'entrance')) "
-             f"and delete_reason is null order by random() limit {count})")
-    db = await get_db()
-    cursor = await db.execute(query)
-    return [POI(r) async for r in cursor]
+    ids = snapshot.get_pool(('random',))
+    if ids is None:
+        query = ("select id from poi where (tag is null or tag not in ('building', 'entrance')) "
+                 "and delete_reason is null")
+        generation = snapshot.generation
+        db = await get_reader()
+        rows = await db.execute_fetchall(query)
+        ids = snapshot.put_pool(('random',), [r[0] for r in rows], generation)
+    return await get_poi_by_ids(random.sample(ids, min(count, len(ids))))
 
 
 async def get_stats():
     stats = {}
-    db = await get_db()
-    cursor = await db.execute("select count(*) from poi where tag = 'building'")
-    stats['buildings'] = (await cursor.fetchone())[0]
-    cursor = await db.execute("select count(*) from poi where tag = 'entrance'")
-    stats['entrances'] = (await cursor.fetchone())[0]
-    cursor = await db.execute("select count(*) from poi where delete_reason is null "
-                              "and (tag is null or tag not in ('building', 'entrance'))")
-    stats['pois'] = (await cursor.fetchone())[0]
-    cursor = await db.execute("select count(*) from stars")
-    stats['stars'] = (await cursor.fetchone())[0]
+    db = await get_reader()
+    rows = await db.execute_fetchall("select count(*) from poi where tag = 'building'")
+    stats['buildings'] = rows[0][0]
+    rows = await db.execute_fetchall("select count(*) from poi where tag = 'entrance'")
+    stats['entrances'] = rows[0][0]
+    rows = await db.execute_fetchall(
+        "select count(*) from poi where delete_reason is null "
+        "and (tag is null or tag not in ('building', 'entrance'))")
+    stats['pois'] = rows[0][0]
+    rows = await db.execute_fetchall("select count(*) from stars")
+    stats['stars'] = rows[0][0]
     return stats
 
 
 async def reindex():
     conn = await get_db()
     await conn.execute("delete from poisearch")
+    await fill_search_index(conn)
+    await conn.commit()
+
+
+async def fill_search_index(conn):
+    """Adds all POI to an empty search index. Does not commit."""
     # Create temporary tag table
     await conn.execute("create table tag_keywords (tag text not null, tagkw text not null)")
     await conn.executemany("insert into tag_keywords (tag, tagkw) values (?, ?)",
                            [(k, ' '.join(v)) for k, v in config.TAGS['tags'].items()])
     await conn.execute(
-        "insert into poisearch (docid, name, keywords, tag) "
+        "insert into poisearch (rowid, name, keywords, tag) "
         "select poi.rowid, replace(replace(name, 'Ё', 'Е'), 'ё', 'е') as name, "
         "  replace(keywords, 'ё', 'е') as keywords, tagkw as tag from poi "
         "left join tag_keywords on poi.tag = tag_keywords.tag "
         "where in_index and delete_reason is null"
     )
     await conn.execute("drop table tag_keywords")
-    await conn.commit()
 
 
 async def get_poi_ages(poi_ids: List[int]) -> Dict[int, int]:
     """Receives a list of poi and returns a dict poi_id -> age in hours."""
     query = ("select id, strftime('%s', current_timestamp) - strftime('%s', updated) "
              "from poi where id in ({})".format(','.join('?' * len(poi_ids))))
-    db = await get_db()
-    cursor = await db.execute(query, tuple(poi_ids))
-    return {r[0]: round(r[1] / 3600) async for r in cursor}
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, tuple(poi_ids))
+    return {r[0]: round(r[1] / 3600) for r in rows}
 
 
 async def set_updated(poi_id: int, updated: str = None) -> str:
@@ -553,3 +704,30 @@ async def set_updated(poi_id: int, updated: str = None) -> str:
         await db.execute("update poi set updated = ? where id = ?", (updated, poi_id))
     await db.commit()
     return old[0]
+
+
+async def get_fsm(chat: int, user: int, since: int) -> Tuple[str, bytes, bytes, int]:
+    query = ("select state, data, bucket, updated from fsm "
+             "where chat = ? and user = ? and updated >= ?")
+    db = await get_reader()
+    rows = await db.execute_fetchall(query, (chat, user, since))
+    return None if not rows else tuple(rows[0])
+
+
+async def save_fsm(rows: List[tuple], deleted: List[Tuple[int, int]]):
+    """Rows are tuples of (chat, user, state, data, bucket, updated)."""
+    db = await get_db()
+    if rows:
+        await db.executemany(
+            "insert or replace into fsm (chat, user, state, data, bucket, updated) "
+            "values (?, ?, ?, ?, ?, ?)", rows)
+    if deleted:
+        await db.executemany("delete from fsm where chat = ? and user = ?", deleted)
+    await db.commit()
+
+
+async def prune_fsm(before: int) -> int:
+    db = await get_db()
+    cursor = await db.execute("delete from fsm where updated < ?", (before,))
+    await db.commit()
+    return cursor.rowcount
@@ -3,6 +3,7 @@ from typing import List, Tuple
 from raybot import config
 import humanized_opening_hours as hoh
 import json
+from functools import lru_cache
 from time import time
 from datetime import datetime
 from math import radians, cos, sqrt
@@ -24,6 +25,42 @@ class Location:
         return sqrt(x * x + y * y) * 6371e3
 
 
+class OpeningHours:
+    """Wraps OHParser to remember is_open() and next_change() results
+    for the current minute. Other attributes are passed to the parser."""
+
+    def __init__(self, parser: hoh.OHParser):
+        self.parser = parser
+        self._minute = None
+        self._memo = {}
+
+    def __getattr__(self, name):
+        return getattr(self.parser, name)
+
+    def _remember(self, key, func, *args):
+        minute = int(time() // 60)
+        if minute != self._minute:
+            self._memo = {}
+            self._minute = minute
+        if key not in self._memo:
+            self._memo[key] = func(*args)
+        return self._memo[key]
+
+    def is_open(self, dt: datetime = None) -> bool:
+        if dt is not None:
+            return self.parser.is_open(dt)
+        return self._remember('is_open', self.parser.is_open)
+
+    def next_change(self, moment: datetime = None) -> datetime:
+        return self._remember(('next_change', moment), self.parser.next_change, moment)
+
+
+@lru_cache(maxsize=1024)
+def parse_hours(hours: str) -> OpeningHours:
+    """Many POI share opening hours, so parsed values are cached."""
+    return OpeningHours(hoh.OHParser(hours))
+
+
 @dataclass
 class POI:
     id: int
@@ -31,7 +68,6 @@ class POI:
     location: Location
     keywords: str
     key: str = None
-    hours: hoh.OHParser = None
     hours_src: str = None
     photo_out: str = None
     photo_in: str = None
@@ -55,7 +91,6 @@ class POI:
             self.name = row['name']
             self.key = row['str_id']
             self.hours_src = row['hours']
-            self.hours = hoh.OHParser(row['hours']) if row['hours'] else None
             self.links = json.loads(row['links'] or '[]')
             self.photo_out = row['photo_out']
             self.photo_in = row['photo_in']
@@ -84,6 +119,10 @@ class POI:
             self.phones = []
             self.links = []
 
+    @property
+    def hours(self) -> OpeningHours:
+        return None if not self.hours_src else parse_hours(self.hours_src)
+
     def get_db_fields(self, orig=None) -> dict:
         def bool_to_int(v):
             if v is None:
@@ -0,0 +1,12 @@
+create table fsm (
+    chat integer not null,
+    user integer not null,
+    state text,
+    data blob,   -- zlib-compressed pickle
+    bucket blob,
+    updated integer not null,  -- unix time
+    primary key (chat, user)
+) without rowid;
+-- Conversation states, written by raybot.model.storage.FsmStorage.
+
+create index fsm_updated on fsm (updated);
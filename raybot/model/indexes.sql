@@ -0,0 +1,15 @@
+-- Indexes for frequent queries in db.py. Run on every start after
+-- migrations, so every statement must be idempotent. To change an index,
+-- drop it here and create it under a new name.
+-- Check plans with "python -m raybot plans".
+
+create index if not exists poi_house_idx on poi (house, flor);
+drop index if exists poi_tag_idx;
+create index if not exists poi_tag_all_idx on poi (tag);
+create index if not exists poi_created_idx on poi (created) where delete_reason is null;
+create index if not exists poi_deleted_idx on poi (updated) where delete_reason is not null;
+create index if not exists poi_unchecked_idx on poi (created) where needs_check;
+create index if not exists queue_ts_idx on queue (ts);
+create index if not exists poi_audit_ts_idx on poi_audit (ts);
+create index if not exists roles_role_idx on roles (role, user_id);
+create index if not exists file_ids_file_id_idx on file_ids (file_id);
@@ -0,0 +1,131 @@
+"""Versioned schema upgrades. The schema version is stored in the
+"user_version" pragma. To change the schema, append a function to
+MIGRATIONS: it receives a connection inside a transaction and must not
+commit. Migrations should also work on databases created before
+versioning, hence the checks for existing tables."""
+import logging
+import os
+import sqlite3
+from typing import List
+from . import db as raydb
+
+
+def split_script(script: str) -> List[str]:
+    """Splits an SQL script into statements, keeping triggers whole."""
+    statements = []
+    current = ''
+    for line in script.splitlines(keepends=True):
+        if not current and (not line.strip() or line.lstrip().startswith('--')):
+            continue
+        current += line
+        if sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ''
+    if current.strip():
+        statements.append(current.strip())
+    return statements
+
+
+async def run_script(conn, name: str):
+    """Runs statements from an SQL file one by one. Unlike executescript,
+    this does not commit the current transaction."""
+    with open(os.path.join(os.path.dirname(__file__), name), 'r') as f:
+        statements = split_script(f.read())
+    for statement in statements:
+        await conn.execute(statement)
+
+
+async def has_table(conn, name: str) -> bool:
+    async with conn.execute("select sql from sqlite_master where name = ?", (name,)) as cursor:
+        return await cursor.fetchone() is not None
+
+
+async def create_tables(conn):
+    if not await has_table(conn, 'poi'):
+        await run_script(conn, 'create_tables.sql')
+
+
+async def add_rtree(conn):
+    if not await has_table(conn, 'poi_rtree'):
+        await run_script(conn, 'poi_rtree.sql')
+        await conn.execute("insert into poi_rtree (id, minlon, maxlon, minlat, maxlat) "
+                           "select id, lon, lon, lat, lat from poi")
+
+
+async def add_fts5(conn):
+    async with conn.execute("select sql from sqlite_master where name = 'poisearch'") as cursor:
+        row = await cursor.fetchone()
+    if not row or 'fts5' not in row[0]:
+        await conn.execute("drop table if exists poisearch")
+        await run_script(conn, 'poisearch.sql')
+        await raydb.fill_search_index(conn)
+
+
+async def add_poi_stars(conn):
+    if not await has_table(conn, 'poi_stars'):
+        await run_script(conn, 'poi_stars.sql')
+        await conn.execute("insert into poi_stars (poi_id, stars) "
+                           "select poi_id, count(*) from stars group by poi_id")
+
+
+async def add_fsm(conn):
+    if not await has_table(conn, 'fsm'):
+        await run_script(conn, 'fsm.sql')
+
+
+async def add_indexes(conn):
+    await run_script(conn, 'indexes.sql')
+
+
+async def drop_map_file_ids(conn):
+    # File ids for maps are kept in memory now
+    await conn.execute("delete from file_ids where path like 'map:%'")
+
+
+# Version N is reached after running the first N functions.
+MIGRATIONS = [
+    create_tables,
+    add_rtree,
+    add_fts5,
+    add_poi_stars,
+    add_fsm,
+    add_indexes,
+    drop_map_file_ids,
+]
+LATEST = len(MIGRATIONS)
+
+
+async def get_version(conn) -> int:
+    async with conn.execute("pragma user_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def migrate(conn, version: int = None) -> int:
+    """Upgrades the database to the latest version, one transaction
+    per migration. Returns the resulting version."""
+    if version is None:
+        version = await get_version(conn)
+    if version > LATEST:
+        raise ValueError(f'Database version {version} is newer than this code '
+                         f'supports ({LATEST})')
+    for i in range(version, LATEST):
+        migration = MIGRATIONS[i]
+        logging.info('Upgrading the database to version %s: %s', i + 1, migration.__name__)
+        await conn.commit()
+        await conn.execute('begin')
+        try:
+            await migration(conn)
+            # The pragma is a part of the transaction
+            await conn.execute(f'pragma user_version = {i + 1}')
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+    return LATEST
+
+
+async def update_indexes(conn):
+    """Creates indexes from indexes.sql that are missing. This runs on every
+    start after migrate(), so changing indexes needs no migration."""
+    await run_script(conn, 'indexes.sql')
+    await conn.commit()
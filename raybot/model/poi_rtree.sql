@@ -0,0 +1,16 @@
+create virtual table poi_rtree using rtree(id, minlon, maxlon, minlat, maxlat);
+-- Kept in sync with poi by the triggers below, used for get_poi_around.
+
+create trigger poi_rtree_insert after insert on poi begin
+  insert into poi_rtree (id, minlon, maxlon, minlat, maxlat)
+  values (new.id, new.lon, new.lon, new.lat, new.lat);
+end;
+
+create trigger poi_rtree_update after update of lon, lat on poi begin
+  update poi_rtree set minlon = new.lon, maxlon = new.lon, minlat = new.lat, maxlat = new.lat
+  where id = new.id;
+end;
+
+create trigger poi_rtree_delete after delete on poi begin
+  delete from poi_rtree where id = old.id;
+end;
@@ -0,0 +1,23 @@
+create table poi_stars (
+    poi_id integer not null primary key,
+    stars integer not null
+);
+create index poi_stars_idx on poi_stars (stars);
+-- Star counts, kept in sync with stars by the triggers below.
+
+create trigger poi_stars_insert after insert on stars begin
+  insert into poi_stars (poi_id, stars) values (new.poi_id, 1)
+  on conflict (poi_id) do update set stars = stars + 1;
+end;
+
+create trigger poi_stars_delete after delete on stars begin
+  update poi_stars set stars = stars - 1 where poi_id = old.poi_id;
+  delete from poi_stars where poi_id = old.poi_id and stars <= 0;
+end;
+
+create trigger poi_stars_update after update of poi_id on stars begin
+  update poi_stars set stars = stars - 1 where poi_id = old.poi_id;
+  delete from poi_stars where poi_id = old.poi_id and stars <= 0;
+  insert into poi_stars (poi_id, stars) values (new.poi_id, 1)
+  on conflict (poi_id) do update set stars = stars + 1;
+end;
@@ -0,0 +1,7 @@
+create virtual table poisearch using fts5(
+  name, keywords, tag,
+  tokenize='unicode61', prefix='2 3'
+);
+-- When modifying poi, also modify rows in poisearch, using the "rowid" column.
+-- Typical search: select * from poisearch join poi on poi.id = poisearch.rowid
+--   where poisearch match 'tokens' order by bm25(poisearch, 5.0, 3.0, 1.0)
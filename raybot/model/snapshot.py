@@ -0,0 +1,141 @@
+import copy
+from .entities import POI
+from typing import Dict, List, Union
+
+
+class PoiSnapshot:
+    """Read-through cache of decoded POI objects, indexed by id, str_id,
+    and by (kind, *args) tuples for lists like POI in a house or with a tag.
+
+    Every function that modifies the poi table must call forget() for changed
+    POI, or clear() for bulk updates. Returned objects are copies, so that
+    editors can modify them freely.
+
+    Also keeps pools of POI ids to choose random POI from. Any change
+    to POI drops all pools.
+
+    Queries run on other connections than writes, so a query can finish
+    after a change has been committed and forgotten. To not store old
+    values, read the generation before a query and pass it to put methods:
+    any forget() or clear() in between makes them skip storing."""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.clear()
+
+    def clear(self):
+        self.generation += 1
+        self._by_id: Dict[int, POI] = {}
+        self._by_key: Dict[str, int] = {}
+        self._lists: Dict[tuple, List[int]] = {}
+        self._pools: Dict[tuple, List[int]] = {}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'pois': len(self._by_id),
+            'lists': len(self._lists),
+            'pools': len(self._pools),
+        }
+
+    @staticmethod
+    def _copy(poi: POI) -> POI:
+        result = copy.copy(poi)
+        result.links = [list(link) for link in poi.links]
+        result.phones = list(poi.phones)
+        return result
+
+    def _count(self, found: bool):
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def get(self, poi_id: int) -> POI:
+        if not self.enabled:
+            return None
+        poi = self._by_id.get(poi_id)
+        self._count(poi is not None)
+        return None if not poi else self._copy(poi)
+
+    def get_by_key(self, key: str) -> POI:
+        return self.get(self._by_key.get(key))
+
+    def get_list(self, key: tuple) -> List[POI]:
+        if not self.enabled:
+            return None
+        ids = self._lists.get(key)
+        found = ids is not None and all(i in self._by_id for i in ids)
+        self._count(found)
+        return None if not found else [self._copy(self._by_id[i]) for i in ids]
+
+    def put(self, poi: POI, generation: int) -> POI:
+        """Stores a POI and returns it."""
+        if self.enabled and poi is not None and generation == self.generation:
+            self._by_id[poi.id] = self._copy(poi)
+            if poi.key:
+                self._by_key[poi.key] = poi.id
+        return poi
+
+    def put_list(self, key: tuple, pois: List[POI], generation: int) -> List[POI]:
+        if self.enabled and generation == self.generation:
+            for poi in pois:
+                self.put(poi, generation)
+            self._lists[key] = [p.id for p in pois]
+        return pois
+
+    def get_pool(self, key: tuple) -> List[int]:
+        if not self.enabled:
+            return None
+        return self._pools.get(key)
+
+    def put_pool(self, key: tuple, ids: List[int], generation: int) -> List[int]:
+        if self.enabled and generation == self.generation:
+            self._pools[key] = ids
+        return ids
+
+    def forget_pools(self, kind: str = None):
+        """Drops pools with keys starting with kind, or all pools."""
+        self.generation += 1
+        for key in list(self._pools.keys()):
+            if kind is None or key[0] == kind:
+                del self._pools[key]
+
+    def forget(self, *pois: Union[int, POI], house: str = None, tag: str = None):
+        """Removes POI and every list they could be a part of, both before
+        and after the change. Pass new values for house and tag if changed
+        POI are not provided."""
+        ids = set()
+        houses = {house} if house else set()
+        tags = {tag} if tag else set()
+        keys = set()
+        for poi in pois:
+            if poi is None:
+                continue
+            poi_id = poi if isinstance(poi, int) else poi.id
+            ids.add(poi_id)
+            for p in (self._by_id.pop(poi_id, None), None if isinstance(poi, int) else poi):
+                if p:
+                    houses.add(p.house)
+                    tags.add(p.tag)
+                    keys.add(p.key)
+        keys.discard(None)
+        # Also increases the generation
+        self.forget_pools()
+
+        for key in keys:
+            self._by_key.pop(key, None)
+        if keys:
+            # House names are stored in POI inside houses
+            for p in list(self._by_id.values()):
+                if p.house in keys:
+                    del self._by_id[p.id]
+        for key, list_ids in list(self._lists.items()):
+            if ((key[0] in ('house', 'entrances') and key[1] in houses) or
+                    (key[0] == 'tag' and key[1] in tags) or
+                    ids.intersection(list_ids)):
+                del self._lists[key]
@@ -0,0 +1,182 @@
+import asyncio
+import copy
+import logging
+import pickle
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from aiogram.dispatcher.storage import BaseStorage
+from . import db
+
+
+class FsmRecord:
+    __slots__ = ('state', 'data', 'bucket', 'updated')
+
+    def __init__(self, state: str = None, data: dict = None, bucket: dict = None,
+                 updated: float = 0):
+        self.state = state
+        self.data = data or {}
+        self.bucket = bucket or {}
+        self.updated = updated
+
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data and not self.bucket
+
+
+def pack(value: dict) -> Optional[bytes]:
+    if not value:
+        return None
+    return zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def unpack(value: bytes) -> dict:
+    if not value:
+        return {}
+    try:
+        return pickle.loads(zlib.decompress(value))
+    except Exception as e:
+        # Classes could have changed between versions
+        logging.warning('Failed to decode conversation data: %s', e)
+        return {}
+
+
+class FsmStorage(BaseStorage):
+    """Conversation states in the bot's database. Recently used records
+    are kept in memory, up to cache_size of them, and changes are written
+    in batches every flush_interval seconds. Records not updated for
+    ttl seconds are forgotten."""
+
+    def __init__(self, ttl: float = 24 * 3600, flush_interval: float = 2,
+                 cache_size: int = 1000):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self._records: Dict[Tuple[int, int], FsmRecord] = OrderedDict()
+        self._dirty = set()
+        self._task = None
+        self._last_prune = 0
+
+    async def _get(self, chat, user) -> FsmRecord:
+        chat, user = (int(v) for v in self.check_address(chat=chat, user=user))
+        key = (chat, user)
+        record = self._records.get(key)
+        if record is not None and 0 < record.updated < time.time() - self.ttl:
+            record = FsmRecord()
+            self._records[key] = record
+        elif record is None:
+            row = await db.get_fsm(chat, user, int(time.time() - self.ttl))
+            record = self._records.get(key)
+            if record is None:
+                record = FsmRecord() if not row else FsmRecord(
+                    row[0], unpack(row[1]), unpack(row[2]), row[3])
+                self._records[key] = record
+                self._evict(keep=key)
+        self._records.move_to_end(key)
+        return record
+
+    def _touch(self, chat, user, record: FsmRecord):
+        record.updated = time.time()
+        self._dirty.add(tuple(int(v) for v in self.check_address(chat=chat, user=user)))
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _evict(self, keep: Tuple[int, int] = None):
+        if len(self._records) <= self.cache_size:
+            return
+        for key in list(self._records.keys()):
+            if key != keep and key not in self._dirty:
+                del self._records[key]
+                if len(self._records) <= self.cache_size:
+                    break
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.exception('Failed to save conversation states: %s', e)
+
+    async def flush(self):
+        if self._dirty:
+            dirty = self._dirty
+            self._dirty = set()
+            rows = []
+            deleted = []
+            for key in dirty:
+                record = self._records[key]
+                if record.is_empty():
+                    deleted.append(key)
+                else:
+                    rows.append((*key, record.state, pack(record.data),
+                                 pack(record.bucket), int(record.updated)))
+            try:
+                await db.save_fsm(rows, deleted)
+            except BaseException:
+                # Writing the same rows again is harmless
+                self._dirty |= dirty
+                raise
+            self._evict()
+        if time.time() - self._last_prune > 3600:
+            self._last_prune = time.time()
+            pruned = await db.prune_fsm(int(time.time() - self.ttl))
+            if pruned:
+                logging.info('Forgot %s stale conversation states', pruned)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._dirty:
+            await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None) -> Optional[str]:
+        record = await self._get(chat, user)
+        return record.state or self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None) -> Dict:
+        record = await self._get(chat, user)
+        return copy.deepcopy(record.data)
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        record = await self._get(chat, user)
+        record.state = self.resolve_state(state)
+        self._touch(chat, user, record)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        record = await self._get(chat, user)
+        record.data = copy.deepcopy(data) or {}
+        self._touch(chat, user, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        record = await self._get(chat, user)
+        record.data.update(copy.deepcopy(data or {}), **copy.deepcopy(kwargs))
+        self._touch(chat, user, record)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        record = await self._get(chat, user)
+        record.state = None
+        if with_data:
+            record.data = {}
+        self._touch(chat, user, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None) -> Dict:
+        record = await self._get(chat, user)
+        return copy.deepcopy(record.bucket)
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        record = await self._get(chat, user)
+        record.bucket = copy.deepcopy(bucket) or {}
+        self._touch(chat, user, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        record = await self._get(chat, user)
+        record.bucket.update(copy.deepcopy(bucket or {}), **copy.deepcopy(kwargs))
+        self._touch(chat, user, record)
@@ -15,9 +15,30 @@ class Config:
         self.TELEGRAM_TOKEN = CONFIG.get('telegram_token')
         self.ADMIN = CONFIG.get('admin_id')
         self.LOGS = self.rel_expand(CONFIG.get('logs', BASE_DIR), ALT_CONFIG_DIR)
+        self.LOG_FLUSH_INTERVAL = float(CONFIG.get('log_flush_interval', 5))
+        self.LOG_MAX_SIZE = float(CONFIG.get('log_max_size', 10))
         self.MAINTENANCE = CONFIG.get('maintenance', False)
         self.BBOX = CONFIG.get('bbox')
+        self.WEBHOOK = CONFIG.get('webhook')
         self.PRUNE_TIMEOUT = int(CONFIG.get('prune_timeout', 10))
+        self.SESSIONS = self.rel_expand(CONFIG.get('sessions'), ALT_CONFIG_DIR)
+        self.FSM_TTL = float(CONFIG.get('fsm_ttl', 24))
+        self.FSM_FLUSH_INTERVAL = float(CONFIG.get('fsm_flush_interval', 2))
+        self.POI_CACHE = CONFIG.get('poi_cache', True)
+        self.DB_READERS = int(CONFIG.get('db_readers', 2))
+        self.DB_PRAGMAS = {
+            'journal_mode': 'wal',
+            'synchronous': 'normal',
+            'mmap_size': 64 * 1024 * 1024,
+            'cache_size': -16000,
+            'temp_store': 'memory',
+            'busy_timeout': 5000,
+            **(CONFIG.get('db_pragmas') or {}),
+        }
+        self.TILE_CACHE = float(CONFIG.get('tile_cache', 64))
+        self.MAP_WORKERS = int(CONFIG.get('map_workers', 2))
+        self.MAP_PROCESSES = CONFIG.get('map_processes', False)
+        self.MAP_CACHE = float(CONFIG.get('map_cache', 8))
         language = CONFIG.get('language', 'ru')
 
         # Common paths
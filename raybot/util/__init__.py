@@ -1,2 +1,2 @@
-from .map import get_map
+from .map import get_map, render_map, get_map_photo, store_map_file_id
 from .util import *
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+from aiogram.utils.exceptions import TelegramAPIError, RetryAfter, Unauthorized, BadRequest
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Set
+
+
+class BroadcastJob:
+    __slots__ = ('chat_id', 'calls', 'attempts')
+
+    def __init__(self, chat_id: int, calls: List[Callable[[], Awaitable]]):
+        self.chat_id = chat_id
+        self.calls = calls
+        self.attempts = 0
+
+
+class Broadcaster:
+    """Sends messages from background tasks, so that handlers don't wait
+    for them. Sending is limited to rate messages per second in total,
+    and one message per chat_interval seconds for each chat. Each chat has
+    a queue that is sent in order by its own task: when a call fails, it is
+    retried with a growing delay before anything else is sent to that chat,
+    except for errors like a blocked bot that won't go away. When Telegram
+    asks to retry later, all sending pauses for that time."""
+
+    def __init__(self, rate: float = 25, chat_interval: float = 1, retries: int = 3):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.retries = retries
+        self._chats: Dict[int, Deque[BroadcastJob]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._lock: asyncio.Lock = None
+        self._tokens = rate
+        self._refilled = time.monotonic()
+        self._paused_until = 0
+        self._next_send: Dict[int, float] = {}
+        self._pending = 0
+
+    def send(self, chat_id: int, *calls: Callable[[], Awaitable]):
+        """Queues calls that send messages to a chat, like
+        lambda: bot.send_message(chat_id, text)."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        self._pending += 1
+        job = BroadcastJob(chat_id, list(calls))
+        if chat_id in self._chats:
+            self._chats[chat_id].append(job)
+        else:
+            self._chats[chat_id] = deque([job])
+            task = asyncio.get_running_loop().create_task(self._run(chat_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _take(self, count: int):
+        """Waits for tokens in the global bucket. Callers wait in turn."""
+        async with self._lock:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens < count:
+                await asyncio.sleep((count - self._tokens) / self.rate)
+                self._tokens = count
+                self._refilled = time.monotonic()
+            self._tokens -= count
+
+    async def _run(self, chat_id: int):
+        queue = self._chats[chat_id]
+        try:
+            while queue:
+                job = queue[0]
+                wait = self._next_send.get(chat_id, 0) - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await self._take(len(job.calls))
+                self._next_send[chat_id] = (time.monotonic() +
+                                            self.chat_interval * len(job.calls))
+                if await self._deliver(job):
+                    queue.popleft()
+                    self._pending -= 1
+        finally:
+            del self._chats[chat_id]
+
+    async def _deliver(self, job: BroadcastJob) -> bool:
+        """Makes calls for a job. Returns False when it should be retried,
+        after setting a delay for the chat."""
+        while job.calls:
+            try:
+                await job.calls[0]()
+            except RetryAfter as e:
+                until = time.monotonic() + e.timeout
+                self._paused_until = max(self._paused_until, until)
+                self._next_send[job.chat_id] = until
+                return False
+            except (Unauthorized, BadRequest) as e:
+                logging.warning('Could not send a message to %s: %s', job.chat_id, e)
+                break
+            except (TelegramAPIError, OSError, asyncio.TimeoutError) as e:
+                job.attempts += 1
+                if job.attempts > self.retries:
+                    logging.error('Giving up sending a message to %s: %s', job.chat_id, e)
+                    break
+                self._next_send[job.chat_id] = time.monotonic() + 2 ** job.attempts
+                return False
+            except Exception:
+                logging.exception('Failed to send a message to %s', job.chat_id)
+                break
+            job.calls.pop(0)
+        return True
+
+    async def close(self, timeout: float = 10):
+        """Waits for queued messages to be sent, up to timeout seconds."""
+        if not self._tasks:
+            return
+        deadline = time.monotonic() + timeout
+        while self._pending > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._pending > 0:
+            logging.warning('Dropping %s unsent messages', self._pending)
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._pending = 0
+
+
+broadcaster = Broadcaster()
@@ -1,10 +1,96 @@
 from raybot import config
+import asyncio
+import csv
+import io
+import logging
 import os
+from collections import defaultdict
 from datetime import datetime
+from typing import Dict, List, Sequence
 from aiogram import types
 from aiogram.dispatcher.middlewares import LifetimeControllerMiddleware
 
 
+class LogSink:
+    """Buffers lines for log files in memory and appends them to files
+    in a background task: every flush_interval seconds, or when
+    flush_lines lines have been collected. Files larger than max_size
+    are rotated, keeping up to backups older files."""
+
+    def __init__(self, path: str, flush_interval: float = 5, flush_lines: int = 200,
+                 max_size: int = 10 * 1024 * 1024, backups: int = 3):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_lines = flush_lines
+        self.max_size = max_size
+        self.backups = backups
+        self._lines: Dict[str, List[str]] = defaultdict(list)
+        self._count = 0
+        self._task = None
+        self._wakeup = None
+
+    def write(self, name: str, row: Sequence):
+        """Queues a tab-separated row for the log file with this name."""
+        out = io.StringIO()
+        csv.writer(out, delimiter='\t', lineterminator='\n').writerow(row)
+        self._lines[name].append(out.getvalue())
+        self._count += 1
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if self._count >= self.flush_lines:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not self._count:
+            return
+        lines = self._lines
+        self._lines = defaultdict(list)
+        self._count = 0
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write_files, lines)
+
+    def _rotate(self, path: str):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{path}.{i}'):
+                os.replace(f'{path}.{i}', f'{path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(path, f'{path}.1')
+        else:
+            os.remove(path)
+
+    def _write_files(self, lines: Dict[str, List[str]]):
+        for name, rows in lines.items():
+            path = os.path.join(self.path, name)
+            try:
+                if self.max_size and os.path.exists(path):
+                    if os.path.getsize(path) > self.max_size:
+                        self._rotate(path)
+                with open(path, 'a') as f:
+                    f.write(''.join(rows))
+            except IOError:
+                logging.warning('Failed to write %s lines to %s', len(rows), name)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+sink = LogSink(config.LOGS, flush_interval=config.LOG_FLUSH_INTERVAL,
+               max_size=int(config.LOG_MAX_SIZE * 1024 * 1024))
+
+
 class LoggingMiddleware(LifetimeControllerMiddleware):
     async def pre_process(self, obj, data, *args):
         if isinstance(obj, types.Message):
@@ -19,6 +105,5 @@ class LoggingMiddleware(LifetimeControllerMiddleware):
         else:
             # not logging updates
             return
-        with open(os.path.join(config.LOGS, 'access.log'), 'a') as f:
-            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            f.write(f'{now}\t{user_id}\t{typ}\n')
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        sink.write('access.log', [now, user_id, typ])
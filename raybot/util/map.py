@@ -1,15 +1,186 @@
 from PIL import Image, ImageDraw, ImageFont
-from typing import Sequence
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Sequence, Dict, List, Tuple, Union
+from io import BytesIO
+from aiogram import types
+import asyncio
+import hashlib
 import math
 import os
-import tempfile
+import sqlite3
 import logging
+import threading
+import time
 from raybot import config
 from raybot.model import Location
 
 
 zooms = None
-cached_tiles = {}
+_executor = None
+_mbtiles = None
+# (modification time of tiles, time of the check)
+_tiles_checked = None
+# Tiles version this process renders with
+_tiles_used = None
+
+
+class TileCache:
+    """LRU cache for decoded tiles, limited by the size of pixel data.
+    Missing tiles share a single placeholder image. Every entry is also
+    charged ENTRY_SIZE bytes, so that missing tiles are evicted too."""
+
+    # Approximate memory for a key, a record and a dict slot
+    ENTRY_SIZE = 300
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tiles = OrderedDict()
+        self._placeholders = {}
+        # Maps can be rendered in several threads
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[Image.Image, bool]:
+        with self._lock:
+            item = self._tiles.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._tiles.move_to_end(key)
+            return item[0], item[1]
+
+    def put(self, key: str, tile: Image.Image, found: bool):
+        size = self.ENTRY_SIZE
+        if found:
+            size += tile.width * tile.height * len(tile.getbands())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._tiles:
+                self.size -= self._tiles.pop(key)[2]
+            self._tiles[key] = (tile, found, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self._tiles.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.size = 0
+
+    def placeholder(self, tilesize: int) -> Image.Image:
+        with self._lock:
+            if tilesize not in self._placeholders:
+                self._placeholders[tilesize] = Image.new(
+                    "RGBA", (tilesize, tilesize), color='#ffeeee')
+            return self._placeholders[tilesize]
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'tiles': len(self._tiles),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': 0 if not total else self.hits / total,
+        }
+
+
+class MapCache:
+    """LRU cache for rendered JPEG maps or their file_ids, limited by
+    their total size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._maps = OrderedDict()
+
+    def get(self, key: str) -> bytes:
+        data = self._maps.get(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._maps.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        if key in self._maps:
+            self.size -= len(self._maps.pop(key))
+        self._maps[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            self.size -= len(self._maps.popitem(last=False)[1])
+
+    def clear(self):
+        self._maps.clear()
+        self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {'maps': len(self._maps), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class MBTiles:
+    """Reads tiles from an MBTiles file. The file is memory-mapped,
+    and each rendering thread has its own read-only connection."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True,
+                                   check_same_thread=False)
+            conn.execute(f'pragma mmap_size = {os.path.getsize(self.path)}')
+            self._local.conn = conn
+        return conn
+
+    def get_zooms(self) -> List[int]:
+        cursor = self._connect().execute(
+            "select distinct zoom_level from tiles order by zoom_level")
+        return [r[0] for r in cursor]
+
+    def read(self, zoom: int, x: int, y: int) -> bytes:
+        # MBTiles use TMS numbering, where rows go from the south
+        cursor = self._connect().execute(
+            "select tile_data from tiles where zoom_level = ? "
+            "and tile_column = ? and tile_row = ?", (zoom, x, (1 << zoom) - 1 - y))
+        row = cursor.fetchone()
+        return None if not row else row[0]
+
+
+def get_mbtiles() -> MBTiles:
+    """Returns the tile archive if config.TILES points to a file."""
+    global _mbtiles
+    if _mbtiles is None and os.path.isfile(config.TILES):
+        _mbtiles = MBTiles(config.TILES)
+    return _mbtiles
+
+
+cached_tiles = TileCache(int(config.TILE_CACHE * 1024 * 1024))
+rendered_maps = MapCache(int(config.MAP_CACHE * 1024 * 1024))
+# Telegram file_ids of sent maps, about ten thousand of them
+map_file_ids = MapCache(1024 * 1024)
+# Seconds between checks for updated tiles
+TILES_RECHECK = 60
+# The zoom level for which user locations are snapped to a grid
+REF_ZOOM = 17
+# Grid step in pixels, 8 pixels is about 5 meters
+REF_GRID = 8
 
 
 def deg2num(lon_deg, lat_deg, zoom):
@@ -20,29 +191,47 @@ def deg2num(lon_deg, lat_deg, zoom):
     return xtile, ytile
 
 
+def num2deg(xtile, ytile, zoom):
+    n = 2.0 ** zoom
+    lon_deg = xtile / n * 360.0 - 180.0
+    lat_deg = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ytile / n))))
+    return lon_deg, lat_deg
+
+
 def get_zooms():
     global zooms
     if zooms or not os.path.exists(config.TILES):
         return zooms
-    zooms = sorted([int(z) for z in os.listdir(config.TILES) if z.isdecimal()])
+    if get_mbtiles():
+        zooms = get_mbtiles().get_zooms()
+    else:
+        zooms = sorted([int(z) for z in os.listdir(config.TILES) if z.isdecimal()])
     return zooms
 
 
 def load_tile(zoom, x, y, tilesize=256):
     k = f'{zoom},{x},{y}'
-    if k in cached_tiles:
-        return cached_tiles[k]
-    path = os.path.join(config.TILES, str(zoom), str(x), f'{y}.png')
+    cached = cached_tiles.get(k)
+    if cached:
+        return cached
+    mbtiles = get_mbtiles()
+    if mbtiles:
+        data = mbtiles.read(zoom, x, y)
+        source = None if not data else BytesIO(data)
+    else:
+        path = os.path.join(config.TILES, str(zoom), str(x), f'{y}.png')
+        source = path if os.path.exists(path) else None
     tile = None
-    if os.path.exists(path):
+    if source:
         try:
-            tile = Image.open(path)
+            tile = Image.open(source)
+            tile.load()
         except IOError:
-            pass
+            tile = None
     found = tile is not None
     if not found:
-        tile = Image.new("RGBA", (tilesize, tilesize), color='#ffeeee')
-    cached_tiles[k] = (tile, found)
+        tile = cached_tiles.placeholder(tilesize)
+    cached_tiles.put(k, tile, found)
     return (tile, found)
 
 
@@ -123,7 +312,7 @@ def find_bounds(coords):
     return minlon, minlat, maxlon, maxlat
 
 
-def get_map(coords: Sequence[Location], ref: Location = None):
+def get_map(coords: Sequence[Location], ref: Location = None) -> BytesIO:
     if not coords:
         return None
     minlon, minlat, maxlon, maxlat = find_bounds(coords + [ref])
@@ -151,7 +340,129 @@ def get_map(coords: Sequence[Location], ref: Location = None):
         draw.ellipse([(x - 8, y - 8), (x + 8, y + 8)], outline='#F51342', fill='#ffffff')
         draw.ellipse([(x - 5, y - 5), (x + 5, y + 5)], fill='#F51342')
 
-    fp = tempfile.NamedTemporaryFile(suffix='.jpg', prefix='raybot-map-')
+    fp = BytesIO()
     image.convert('RGB').save(fp, 'JPEG', quality=80)
     fp.seek(0)
     return fp
+
+
+def tiles_version() -> int:
+    """Returns the modification time of the tiles file or directory, checked
+    once a minute. When it changes, rendered maps and their file_ids are
+    forgotten. After updating tiles in a directory, touch the directory."""
+    global _tiles_checked
+    now = time.monotonic()
+    if _tiles_checked and now - _tiles_checked[1] < TILES_RECHECK:
+        return _tiles_checked[0]
+    try:
+        version = int(os.stat(config.TILES).st_mtime)
+    except OSError:
+        version = 0
+    if _tiles_checked and _tiles_checked[0] != version:
+        logging.info('Tiles have been updated, forgetting rendered maps')
+        rendered_maps.clear()
+        map_file_ids.clear()
+    _tiles_checked = (version, now)
+    return version
+
+
+def use_tiles(version: int):
+    """Drops decoded tiles and the tile archive when tiles have been updated.
+    Called in every rendering thread or process."""
+    global _tiles_used, _mbtiles, zooms
+    if _tiles_used is not None and _tiles_used != version:
+        _mbtiles = None
+        zooms = None
+        cached_tiles.clear()
+    _tiles_used = version
+
+
+def render_map_bytes(coords: Sequence[Location], ref: Location = None,
+                     version: int = None) -> bytes:
+    """Same as get_map(), but returns JPEG contents. Runs in the executor."""
+    if version is not None:
+        use_tiles(version)
+    fp = get_map(coords, ref)
+    return None if not fp else fp.getvalue()
+
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if config.MAP_PROCESSES:
+            _executor = ProcessPoolExecutor(max_workers=config.MAP_WORKERS)
+        else:
+            # Pillow releases the GIL for decoding, drawing and encoding
+            _executor = ThreadPoolExecutor(max_workers=config.MAP_WORKERS,
+                                           thread_name_prefix='raybot-map')
+    return _executor
+
+
+def snap_ref(ref: Location) -> Location:
+    """Moves a location to the nearest node of a pixel grid, so that
+    maps for close locations look the same and can be reused."""
+    if not ref:
+        return ref
+    step = REF_GRID / 256
+    x, y = deg2num(ref.lon, ref.lat, REF_ZOOM)
+    lon, lat = num2deg(round(x / step) * step, round(y / step) * step, REF_ZOOM)
+    return Location(lon=lon, lat=lat)
+
+
+def map_key(coords: Sequence[Location], ref: Location = None, version: int = 0) -> str:
+    """Makes a cache key for a map with given tiles version."""
+    parts = [f'{c.lon:.6f},{c.lat:.6f}' for c in coords]
+    if ref:
+        parts.append(f'r{ref.lon:.6f},{ref.lat:.6f}')
+    parts.append(f'z{REF_ZOOM}')
+    parts.append(f't{version}')
+    return hashlib.sha1(';'.join(parts).encode()).hexdigest()[:20]
+
+
+async def render_map(coords: Sequence[Location], ref: Location = None) -> bytes:
+    """Renders a map without blocking the event loop.
+    Snap the ref location with snap_ref() to make use of the cache."""
+    if not coords:
+        return None
+    version = tiles_version()
+    key = map_key(coords, ref, version)
+    data = rendered_maps.get(key)
+    if data is None:
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(
+            get_executor(), render_map_bytes, list(coords), ref, version)
+        if data:
+            rendered_maps.put(key, data)
+    return data
+
+
+async def get_map_photo(coords: Sequence[Location], ref: Location = None
+                        ) -> Tuple[str, Union[str, types.InputFile]]:
+    """Returns a key and either a file_id of an uploaded map, or a file
+    to upload. After uploading, store the file_id with
+    store_map_file_id(key, file_id). Returns (None, None) when
+    there is no map."""
+    if not coords:
+        return None, None
+    ref = snap_ref(ref)
+    key = map_key(coords, ref, tiles_version())
+    file_id = map_file_ids.get(key)
+    if file_id:
+        return key, file_id
+    data = await render_map(coords, ref)
+    if not data:
+        return None, None
+    return key, types.InputFile(BytesIO(data), filename='map.jpg')
+
+
+def store_map_file_id(key: str, file_id: str):
+    """Remembers a file_id for a map uploaded to Telegram. These are kept
+    in memory only, and the least recently sent are forgotten."""
+    map_file_ids.put(key, file_id)
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
@@ -0,0 +1,64 @@
+from raybot import config
+from raybot.model import db
+from typing import Dict, Optional, Tuple
+import os
+import time
+
+
+class PhotoRegistry:
+    """Remembers sizes of photo files and Telegram file_ids for them, so that
+    showing a photo needs neither disk access nor a query. A file is checked
+    again when recheck seconds have passed, and its file_id is forgotten
+    when the file has been modified. File ids are read from the database
+    on first use and are written through to it."""
+
+    def __init__(self, path: str, recheck: float = 60):
+        self.path = path
+        self.recheck = recheck
+        # filename -> (size or None, mtime, time of the check)
+        self._files: Dict[str, Tuple[Optional[int], float, float]] = {}
+        # key -> (size, file_id)
+        self._file_ids: Dict[str, Tuple[int, str]] = None
+
+    def size(self, filename: str) -> Optional[int]:
+        """Returns the size of a file in the photos directory, or None
+        when there is no such file."""
+        now = time.monotonic()
+        entry = self._files.get(filename)
+        if entry and now - entry[2] < self.recheck:
+            return entry[0]
+        try:
+            st = os.stat(os.path.join(self.path, filename))
+            size, mtime = st.st_size, st.st_mtime
+        except OSError:
+            size, mtime = None, 0
+        if entry and entry[1] != mtime and self._file_ids is not None:
+            self._file_ids.pop(filename.rsplit('.', 1)[0], None)
+            self._file_ids.pop(filename, None)
+        self._files[filename] = (size, mtime, now)
+        return size
+
+    def forget(self, filename: str):
+        self._files.pop(filename, None)
+
+    async def _load(self):
+        if self._file_ids is None:
+            self._file_ids = await db.get_file_ids()
+
+    async def find(self, keys: Dict[str, int]) -> Dict[str, str]:
+        """Same as db.find_file_ids: receives a dict of key -> size."""
+        await self._load()
+        result = {}
+        for key, size in keys.items():
+            entry = self._file_ids.get(key)
+            if entry and entry[0] == size:
+                result[key] = entry[1]
+        return result
+
+    async def store(self, key: str, size: int, file_id: str):
+        await self._load()
+        self._file_ids[key] = (size, file_id)
+        await db.store_file_id(key, size, file_id)
+
+
+photo_registry = PhotoRegistry(config.PHOTOS)
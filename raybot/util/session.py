@@ -0,0 +1,131 @@
+from raybot import config
+from raybot.model import UserInfo, Location
+from collections import OrderedDict
+from typing import Dict, List
+import json
+import logging
+import os
+import sys
+import time
+
+
+class SessionStore:
+    """Keeps UserInfo objects ordered by last access time, so that expired
+    sessions are always at the front and can be pruned without a full scan.
+
+    When a path is given, sessions are saved there on shutdown and restored
+    on start. Roles are not saved: they are read from the database when
+    a user comes back."""
+
+    def __init__(self, timeout: float, path: str = None):
+        self.timeout = timeout
+        self.path = path
+        self.evicted = 0
+        self._users: Dict[int, UserInfo] = OrderedDict()
+        self._restored: Dict[int, dict] = OrderedDict()
+
+    def __len__(self):
+        return len(self._users)
+
+    def get(self, user_id: int) -> UserInfo:
+        info = self._users.get(user_id)
+        if info:
+            info.last_access = time.time()
+            self._users.move_to_end(user_id)
+        return info
+
+    def put(self, info: UserInfo):
+        data = self._restored.pop(info.id, None)
+        if data:
+            self._restore(info, data)
+        info.last_access = time.time()
+        self._users[info.id] = info
+        self._users.move_to_end(info.id)
+
+    def forget(self, user_id: int):
+        self._users.pop(user_id, None)
+        self._restored.pop(user_id, None)
+
+    def prune(self, except_id: int = None) -> List[int]:
+        """Removes expired sessions and returns their user ids."""
+        deadline = time.time() - self.timeout
+        while self._restored:
+            user_id, data = next(iter(self._restored.items()))
+            if data['last_access'] >= deadline:
+                break
+            del self._restored[user_id]
+
+        pruned = []
+        while self._users:
+            user_id, info = next(iter(self._users.items()))
+            if info.last_access >= deadline:
+                break
+            if user_id == except_id:
+                self.get(user_id)
+            else:
+                del self._users[user_id]
+                pruned.append(user_id)
+        self.evicted += len(pruned)
+        return pruned
+
+    def stats(self) -> Dict[str, int]:
+        """Sizes are approximate: nested objects are not measured fully."""
+        size = sys.getsizeof(self._users) + sys.getsizeof(self._restored)
+        for info in self._users.values():
+            size += sys.getsizeof(info) + sys.getsizeof(info.__dict__)
+            if info.review:
+                size += sum(sys.getsizeof(r) for r in info.review)
+        return {
+            'users': len(self._users),
+            'restored': len(self._restored),
+            'evicted': self.evicted,
+            'bytes': size,
+        }
+
+    @staticmethod
+    def _dump(info: UserInfo) -> dict:
+        data = {'id': info.id, 'last_access': int(info.last_access)}
+        location = info.location
+        if location:
+            data['loc'] = [location.lon, location.lat, int(info.location_time)]
+        if info.review:
+            data['review'] = info.review
+            data['review_ctx'] = info.review_ctx
+        return data
+
+    @staticmethod
+    def _restore(info: UserInfo, data: dict):
+        if 'loc' in data:
+            info._location = Location(lon=data['loc'][0], lat=data['loc'][1])
+            info.location_time = data['loc'][2]
+        if 'review' in data:
+            info.review = data['review']
+            info.review_ctx = None if not data['review_ctx'] else tuple(data['review_ctx'])
+
+    def save(self):
+        if not self.path:
+            return
+        rows = [self._dump(info) for info in self._users.values()]
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(rows, f, separators=(',', ':'))
+        except IOError as e:
+            logging.warning('Failed to save sessions: %s', e)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                rows = json.load(f)
+        except (IOError, ValueError) as e:
+            logging.warning('Failed to load sessions: %s', e)
+            return
+        deadline = time.time() - self.timeout
+        for data in sorted(rows, key=lambda d: d['last_access']):
+            if data['last_access'] >= deadline:
+                self._restored[data['id']] = data
+        logging.info('Restored %s user sessions', len(self._restored))
+
+
+sessions = SessionStore(config.PRUNE_TIMEOUT * 60, config.SESSIONS)
@@ -1,19 +1,22 @@
 from raybot import config
 from raybot.model import db, UserInfo, Location
+from raybot.util.session import sessions
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 from aiogram.utils.exceptions import TelegramAPIError, MessageToDeleteNotFound
-from typing import List, Union, Dict, Sequence
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import List, Union, Dict, Sequence, Mapping, Tuple
+import os
 import re
-import time
 import base64
 import struct
 
 
-userdata = {}
 # Markdown requires too much escaping, so we're using HTML
 HTML = types.ParseMode.HTML
 SYNONIMS = {}
+PREDEFINED = None
 DOW = ['Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa', 'Su']
 
 
@@ -31,6 +34,48 @@ def reverse_synonims():
     return result
 
 
+@dataclass(frozen=True)
+class PredefinedResponse:
+    order: int
+    content: str
+    role: str = None
+    photo: str = None
+    photo_path: str = None
+    buttons: list = None
+
+
+def index_predefined() -> Mapping[str, Tuple[PredefinedResponse]]:
+    """Builds a read-only index of predefined responses by lowercase keywords."""
+    result: Dict[str, List[PredefinedResponse]] = {}
+    for i, resp in enumerate(config.RESP['responses']):
+        content = resp.get('name', '')
+        if 'message' in resp:
+            if content:
+                content += '\n\n'
+            content += resp['message']
+        photo = resp.get('photo')
+        entry = PredefinedResponse(
+            order=i, content=content, role=resp.get('role'), photo=photo,
+            photo_path=None if not photo else os.path.join(config.PHOTOS, photo),
+            buttons=resp.get('buttons'),
+        )
+        for k in set(k.lower() for k in resp['keywords']):
+            result.setdefault(k, []).append(entry)
+    return MappingProxyType({k: tuple(v) for k, v in result.items()})
+
+
+def find_predefined(*queries: str) -> List[PredefinedResponse]:
+    """Returns responses for any of the queries, in the configuration order."""
+    global PREDEFINED
+    if PREDEFINED is None:
+        PREDEFINED = index_predefined()
+    found = {}
+    for q in queries:
+        for entry in PREDEFINED.get(q, ()):
+            found[entry.order] = entry
+    return [found[k] for k in sorted(found)]
+
+
 def has_keyword(token, keywords, kwsuffix=''):
     for k in keywords:
         if token == k + kwsuffix:
@@ -39,12 +84,11 @@ def has_keyword(token, keywords, kwsuffix=''):
 
 
 async def get_user(user: types.User):
-    info = userdata.get(user.id)
+    info = sessions.get(user.id)
     if not info:
         info = UserInfo(user)
         info.roles = await db.get_roles(user.id)
-        userdata[user.id] = info
-    info.last_access = time.time()
+        sessions.put(info)
     return info
 
 
@@ -55,19 +99,11 @@ async def save_location(message: types.Message):
 
 
 def prune_users(except_id: int) -> List[int]:
-    pruned = []
-    for user_id in list(userdata.keys()):
-        if user_id != except_id:
-            data = userdata.get(user_id)
-            if data and time.time() - data.last_access > config.PRUNE_TIMEOUT * 60:
-                pruned.append(user_id)
-                del userdata[user_id]
-    return pruned
+    return sessions.prune(except_id)
 
 
 def forget_user(user_id: int):
-    if user_id in userdata:
-        del userdata[user_id]
+    sessions.forget(user_id)
 
 
 def split_tokens(message, process=True):
@@ -0,0 +1,87 @@
+from raybot import config
+from raybot.bot import bot, dp
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+import asyncio
+import logging
+
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """Receives updates over HTTP and hands them to a fixed number of workers
+    through a bounded queue. When the queue is full, requests wait for up to
+    queue_timeout seconds and then fail, so that Telegram retries them later."""
+
+    def __init__(self, workers: int = 4, queue_size: int = 100,
+                 queue_timeout: float = 10, secret: str = None):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.secret = secret
+        self.queue: asyncio.Queue = None
+        self.queue_size = queue_size
+        self._tasks = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            raise web.HTTPUnauthorized()
+        try:
+            update = types.Update(**(await request.json()))
+        except (ValueError, TypeError):
+            raise web.HTTPBadRequest()
+        try:
+            await asyncio.wait_for(self.queue.put(update), self.queue_timeout)
+        except asyncio.TimeoutError:
+            logging.warning('Update queue is full, rejecting update %s', update.update_id)
+            raise web.HTTPServiceUnavailable()
+        return web.Response(text='ok')
+
+    async def _work(self):
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+        while True:
+            update = await self.queue.get()
+            try:
+                await dp.process_update(update)
+            except Exception:
+                logging.exception('Failed to process update %s', update.update_id)
+            finally:
+                self.queue.task_done()
+
+    async def start(self, app: web.Application):
+        self.queue = asyncio.Queue(self.queue_size)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        if config.WEBHOOK.get('url'):
+            await bot.set_webhook(config.WEBHOOK['url'], secret_token=self.secret,
+                                  max_connections=self.workers)
+
+    async def stop(self, app: web.Application):
+        # Finish what has been received
+        try:
+            await asyncio.wait_for(self.queue.join(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            logging.warning('Dropping %s updates on shutdown', self.queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def run_webhook(on_shutdown):
+    server = WebhookServer(
+        workers=int(config.WEBHOOK.get('workers', 4)),
+        queue_size=int(config.WEBHOOK.get('queue', 100)),
+        secret=config.WEBHOOK.get('secret'),
+    )
+
+    async def shutdown(app: web.Application):
+        await server.stop(app)
+        await on_shutdown(dp)
+        await (await bot.get_session()).close()
+
+    app = web.Application()
+    app.router.add_post(config.WEBHOOK.get('path', '/'), server.handle)
+    app.on_startup.append(server.start)
+    app.on_shutdown.append(shutdown)
+    web.run_app(app, host=config.WEBHOOK.get('host', '127.0.0.1'),
+                port=int(config.WEBHOOK.get('port', 8080)))